@@ -0,0 +1,117 @@
+""" Benchmark find_closest_pp against the previous linear accuracy sweep,
+comparing the number of pp evaluations and the wall time.
+
+Requires oppai and a .osu file. Run from the repository root:
+
+    python -m benchmarks.osu_closest_pp [path/to/beatmap.osu]
+
+The beatmap defaults to the last map downloaded by the osu! plugin.
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+from plugins.osulib import pp, args
+
+
+# Accuracies to find the pp of, which are then searched for
+target_accuracies = [85.0, 93.5, 97.0, 98.75, 99.6]
+sweep_step = .05
+
+
+class CountingPP:
+    """ Wraps ezpp_pp and counts the number of evaluations. """
+    def __init__(self, ezpp_pp):
+        self.ezpp_pp = ezpp_pp
+        self.count = 0
+
+    def __call__(self, ez):
+        self.count += 1
+        return self.ezpp_pp(ez)
+
+
+def pp_at(beatmap: str, accuracy: float):
+    """ Return the nomod pp of the beatmap at the given accuracy. """
+    ez = pp.ezpp_new()
+    pp.ezpp_set_autocalc(ez, 1)
+    pp.ezpp_data_dup(ez, beatmap, len(beatmap.encode(errors="replace")))
+    pp.ezpp_set_accuracy_percent(ez, accuracy)
+    result = pp.ezpp_pp(ez)
+    pp.ezpp_free(ez)
+    return result
+
+
+def sweep_closest_pp(beatmap: str, parsed_args):
+    """ The previous search, stepping down from 100% accuracy until the pp is passed. """
+    ez = pp.ezpp_new()
+    pp.ezpp_set_autocalc(ez, 1)
+    pp.ezpp_data_dup(ez, beatmap, len(beatmap.encode(errors="replace")))
+    target_pp = parsed_args.pp
+
+    def calc(accuracy: float):
+        pp.ezpp_set_score_version(ez, parsed_args.score_version)
+        pp.ezpp_set_nmiss(ez, parsed_args.misses)
+        pp.ezpp_set_mods(ez, 0)
+        pp.ezpp_set_accuracy_percent(ez, accuracy)
+        return pp.ezpp_pp(ez)
+
+    calc(0.0)
+    previous_pp = calc(100.0)
+    acc = 100.0 - sweep_step
+    while True:
+        current_pp = calc(acc)
+        if current_pp <= target_pp <= previous_pp:
+            break
+
+        previous_pp = current_pp
+        acc -= sweep_step
+
+    pp.ezpp_free(ez)
+    closest_pp = min([previous_pp, current_pp], key=lambda v: abs(target_pp - v))
+    return round(acc if closest_pp == current_pp else acc + sweep_step, 2)
+
+
+def measure(function, *function_args):
+    """ Return the result, number of evaluations and seconds spent calling the function. """
+    counter = CountingPP(pp.ezpp_pp)
+    pp.ezpp_pp = counter
+    try:
+        started = time.perf_counter()
+        result = function(*function_args)
+        elapsed = time.perf_counter() - started
+    finally:
+        pp.ezpp_pp = counter.ezpp_pp
+
+    return result, counter.count, elapsed
+
+
+def main():
+    if not pp.can_calc_pp:
+        print("Skipping: oppai is not installed")
+        return
+
+    path = sys.argv[1] if len(sys.argv) > 1 else pp.beatmap_path
+    if not os.path.exists(path):
+        print("Skipping: {} does not exist".format(path))
+        return
+
+    with open(path, encoding="utf-8", errors="replace") as f:
+        beatmap = f.read()
+
+    loop = asyncio.get_event_loop()
+    print("{:>8} {:>10} {:>16} {:>16}".format("acc", "pp", "sweep", "bisection"))
+    for accuracy in target_accuracies:
+        target_pp = pp_at(beatmap, accuracy)
+        parsed_args = args.parse("{:.2f}pp".format(target_pp))
+
+        sweep_acc, sweep_count, sweep_time = measure(sweep_closest_pp, beatmap, parsed_args)
+        stats, count, elapsed = measure(lambda: loop.run_until_complete(pp.find_closest_pp(beatmap, parsed_args)))
+
+        print("{:>7.2f}% {:>8.2f}pp {:>5} {:>8.2f}ms {:>5} {:>8.2f}ms  ({:.2f}% / {:.2f}%)".format(
+            accuracy, target_pp, sweep_count, sweep_time * 1000, count, elapsed * 1000, sweep_acc, stats.acc))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+""" Benchmark the pp argument parser against the previous parser, which tried
+every argument pattern against every user argument.
+
+Run from the repository root:
+
+    python -m benchmarks.osu_pp_args
+"""
+
+import re
+import timeit
+from collections import namedtuple
+
+from plugins.osulib import args
+
+
+# Typical option strings given to !pp
+option_strings = [
+    "",
+    "99.5%",
+    "+HDDT 98%",
+    "+HR 97.3% 2m",
+    "+HDHR 1200x 3x100 1x50 2m",
+    "95% 500x 1m scorev2 +EZ",
+    "ar10.3 od9 cs4 hp7 +DT 99%",
+    "400pp +HD",
+    "300hits 99% Srank",
+]
+number = 2000
+
+
+class OldRegexArgumentParser:
+    """ The parser used before the argument patterns were compiled into one. """
+    Argument = namedtuple("Argument", "pattern kwarg_pattern type default")
+
+    def __init__(self, parser: args.RegexArgumentParser):
+        self.arguments = {name: self.Argument(pattern=re.compile(arg.pattern, flags=re.IGNORECASE),
+                                              kwarg_pattern=re.compile(r"{}=(?P<value>\S+)".format(name)),
+                                              type=arg.type, default=arg.default)
+                          for name, arg in parser.arguments.items()}
+
+    def parse(self, *user_args):
+        Namespace = namedtuple("Namespace", " ".join(self.arguments.keys()))
+        _namespace = {name: arg.default for name, arg in self.arguments.items()}
+
+        for user_arg in user_args:
+            for name, arg in self.arguments.items():
+                if _namespace[name] is not arg.default:
+                    continue
+
+                match = arg.pattern.fullmatch(user_arg)
+                if match:
+                    _namespace[name] = arg.type(match.group(1))
+                    break
+
+                match = arg.kwarg_pattern.fullmatch(user_arg)
+                if match:
+                    _namespace[name] = arg.type(match.group("value"))
+                    break
+            else:
+                raise ValueError("{} is an invalid argument.".format(user_arg))
+
+        return Namespace(**_namespace)
+
+
+def run(parse):
+    for options in option_strings:
+        parse(*options.split())
+
+
+def main():
+    old_parser = OldRegexArgumentParser(args.parser)
+
+    # Both parsers should agree before comparing their speed
+    for options in option_strings:
+        assert tuple(old_parser.parse(*options.split())) == tuple(args.parse(*options.split())), options
+
+    old_time = timeit.timeit(lambda: run(old_parser.parse), number=number)
+    new_time = timeit.timeit(lambda: run(args.parse), number=number)
+
+    per_parse = number * len(option_strings) / 1000000
+    print("Parsed {} option strings {} times".format(len(option_strings), number))
+    print("Old parser: {:.2f}s ({:.2f}us per parse)".format(old_time, old_time / per_parse))
+    print("New parser: {:.2f}s ({:.2f}us per parse)".format(new_time, new_time / per_parse))
+    print("Speedup: {:.1f}x".format(old_time / new_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,9 +5,13 @@ Commands:
 import logging
 import random
 import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from io import BytesIO
 
+import asyncio
 from PIL import Image, ImageSequence, ImageOps
 import discord
 
@@ -25,6 +29,7 @@ except:
 # See if we can create gifs using imageio
 try:
     import imageio
+    import numpy
 except:
     gif_support = False
 
@@ -36,6 +41,53 @@ mention_regex = re.compile(r"<@!?(?P<id>\d+)>")
 max_bytes = 4096 ** 2  # 4 MB
 max_gif_bytes = 1024 * 6000  # 128kB
 
+image_workers = 4  # The number of worker threads used for processing images
+image_executor = None  # Created on first use by get_image_executor()
+image_job_timeout = 30  # The number of seconds an image may be processed for
+on_job_timeout = "**Processing this image took too long.**"
+max_job_pixels = 3000 * 3000 * 8  # The maximum number of pixels in all frames of an image
+
+# Recently used images, where every key is a URL, attachment id, emoji or emote. Still images are
+# stored decoded and animated images are stored as bytes, as every frame would have to be decoded
+image_cache = OrderedDict()
+image_cache_bytes = 0  # The number of bytes currently used by the image cache
+max_image_cache_bytes = 64 * 1024 ** 2  # 64 MB
+
+
+def get_image_executor():
+    """ Return the thread pool used for processing images outside of the event loop. """
+    global image_executor
+    if image_executor is None:
+        image_executor = ThreadPoolExecutor(max_workers=image_workers)
+
+    return image_executor
+
+
+async def run_image_job(function, *args, **kwargs):
+    """ Run the function in the image executor, and return the result. Pillow releases the GIL
+    while decoding, encoding and transforming, so jobs run in parallel.
+
+    Jobs that can be split into steps should also check a deadline with check_deadline(), as the
+    worker keeps running after we stop waiting.
+
+    :raises AssertionError: When the job takes longer than image_job_timeout seconds.
+    """
+    loop = asyncio.get_event_loop()
+    future = loop.run_in_executor(get_image_executor(), partial(function, *args, **kwargs))
+    try:
+        return await asyncio.wait_for(future, image_job_timeout)
+    except asyncio.TimeoutError:
+        raise AssertionError(on_job_timeout)
+
+
+def check_deadline(deadline: float):
+    """ Stop an image job when time.monotonic() has passed the deadline, so that the worker is freed.
+
+    :raises AssertionError: When the deadline has passed.
+    """
+    if time.monotonic() > deadline:
+        raise AssertionError(on_job_timeout)
+
 
 def convert_image(image_object, mode, real_convert=True):
     """ Convert the image object to a specified mode. """
@@ -61,10 +113,20 @@ def to_jpg(image_object, quality, real_convert=True):
     return Image.open(utils.convert_image_object(image_object, "JPEG", quality=quality))
 
 
+def to_frame_array(frame):
+    """ Convert a frame to an array for the GIF writer. Palette frames are converted to RGBA,
+    as the writer expects the actual colors. """
+    if frame.mode not in ("L", "RGB", "RGBA"):
+        frame = frame.convert("RGBA")
+
+    return numpy.asarray(frame)
+
+
 class ImageArg:
-    def __init__(self, image_object: Image.Image, format: str):
+    def __init__(self, image_object: Image.Image, format: str, shared: bool=False):
         self.object = image_object
         self.format = format
+        self.shared = shared  # The image object is shared with the image cache, and must be copied before modifying
         self.extension = format.lower()
         self.clean_format()
 
@@ -84,44 +146,116 @@ class ImageArg:
         self.extension = self.format = ext
 
 
-    def modify(self, function, *args, convert=None, **kwargs):
-        """ Modify the image object using the given Image function.
+    def check_size(self):
+        """ Make sure the image is small enough to process. """
+        width, height = self.object.size
+        frames = getattr(self.object, "n_frames", 1) if self.gif else 1
+        assert width * height * frames <= max_job_pixels, "**This image is too large to process.**"
+
+    async def modify(self, function, *args, convert=None, **kwargs):
+        """ Modify the image object using the given Image function in the image executor.
         This function supplies sequence support. """
+        deadline = time.monotonic() + image_job_timeout
+        await run_image_job(self._modify, function, *args, convert=convert, deadline=deadline, **kwargs)
+
+    def _modify(self, function, *args, convert=None, deadline: float, **kwargs):
+        """ Modify the image object. This method is meant to be run in the image executor, and stops
+        between every transform and frame when the deadline has passed, see check_deadline(). """
+        self.check_size()
+        functions = function if type(function) is list else [function]
+
         if not gif_support or not self.gif:
+            # Some functions modify the image in place, so make sure not to modify the cached image
+            image_object = self.object.copy() if self.shared else self.object
+
             if convert:
-                self.object = convert_image(self.object, convert)
+                image_object = convert_image(image_object, convert)
+
+            for func in functions:
+                check_deadline(deadline)
+                image_object = func(image_object, *args, **kwargs)
 
-            if type(function) is list:
-                for func in function:
-                    self.object = func(self.object, *args, **kwargs)
-            else:
-                self.object = function(self.object, *args, **kwargs)
+            # The image is only replaced when every transform is done in time
+            check_deadline(deadline)
+            self.object = image_object
+            self.shared = False
         else:
-            frames = []
+            # Every frame is written as soon as it's modified, so that only one is kept in memory
+            buffer = BytesIO()
             duration = self.object.info.get("duration") / 1000
-            for frame in ImageSequence.Iterator(self.object):
-                if convert:
-                    frame = convert_image(frame, convert, real_convert=False)
+            with imageio.get_writer(buffer, format=self.format, mode="I", duration=duration) as writer:
+                for frame in ImageSequence.Iterator(self.object):
+                    if convert:
+                        frame = convert_image(frame, convert, real_convert=False)
 
-                if type(function) is list:
-                    for func in function:
+                    for func in functions:
+                        check_deadline(deadline)
                         frame = func(frame, *args, **kwargs)
-                    frame_bytes = utils.convert_image_object(frame)
-                else:
-                    frame_bytes = utils.convert_image_object(function(frame, *args, **kwargs))
-                frames.append(imageio.imread(frame_bytes, format="PNG"))
+                    writer.append_data(to_frame_array(frame))
 
             # Save the image as bytes and recreate the image object
-            image_bytes = imageio.mimwrite(imageio.RETURN_BYTES, frames, format=self.format, duration=duration)
+            check_deadline(deadline)
+            image_bytes = buffer.getvalue()
             self.object = Image.open(BytesIO(image_bytes))
             self.gif_bytes = image_bytes
     
 
+def get_cached_image(key: str):
+    """ Return an image argument of the cached image, or None if the image is not cached. """
+    if key not in image_cache:
+        return None
+
+    image_cache.move_to_end(key)
+    image_object, image_bytes, image_format, _ = image_cache[key]
+
+    # Animated images are opened again, since the frames are read from the image object
+    if image_bytes is not None:
+        return ImageArg(Image.open(BytesIO(image_bytes)), format=image_format)
+
+    return ImageArg(image_object, format=image_format, shared=True)
+
+
+async def cache_image(key: str, image_object: Image.Image, image_format: str, image_bytes: BytesIO=None):
+    """ Decode the image, store it in the cache and return an image argument of it.
+    The least recently used images are removed when the cache is too big.
+
+    :param image_bytes: The file the image was opened from, which is stored for animated images.
+    """
+    global image_cache_bytes
+
+    if image_object.info.get("duration"):
+        if image_bytes is None:  # Animated images can only be cached as bytes
+            return ImageArg(image_object, format=image_format)
+        image_bytes = image_bytes.getvalue()
+        size = len(image_bytes)
+    else:
+        image_bytes = None
+        await run_image_job(image_object.load)
+        width, height = image_object.size
+        size = width * height * len(image_object.getbands())
+
+    if key in image_cache:
+        image_cache_bytes -= image_cache.pop(key)[3]
+
+    if size <= max_image_cache_bytes:
+        image_cache[key] = (image_object, image_bytes, image_format, size)
+        image_cache_bytes += size
+
+        while image_cache_bytes > max_image_cache_bytes:
+            image_cache_bytes -= image_cache.popitem(last=False)[1][3]
+
+    return get_cached_image(key) or ImageArg(image_object, format=image_format)
+
+
 async def convert_attachment(attachment):
     """ Convert an attachment to an image argument. 
     
     Returns None if the attachment is not an image.
     """
+    image_arg = get_cached_image(attachment["id"])
+    if image_arg:
+        return image_arg
+
     url = attachment["url"]
     headers = await utils.retrieve_headers(url)
     match = extension_regex.search(headers["CONTENT-TYPE"])
@@ -131,7 +265,7 @@ async def convert_attachment(attachment):
     image_format = match.group("ext")
     image_bytes = await utils.download_file(url, bytesio=True)
     image_object = Image.open(image_bytes)
-    return ImageArg(image_object, format=image_format)
+    return await cache_image(attachment["id"], image_object, image_format, image_bytes)
 
 
 
@@ -170,34 +304,51 @@ async def image(message: discord.Message, url_or_emoji: str):
     if "http://" in url_or_emoji or "https://" in url_or_emoji:
         url_or_emoji = url_or_emoji.strip("<>")
 
+        # Use the previously downloaded image
+        image_arg = get_cached_image(url_or_emoji)
+        if image_arg:
+            return image_arg
+
     try:  # Check if the given string is a url and save the headers for later
         headers = await utils.retrieve_headers(url_or_emoji)
     except ValueError:  # Not a valid url, let's see if it's a mention
         match = mention_regex.match(url_or_emoji)
         if match:
             member = message.server.get_member(match.group("id"))
+            image_arg = get_cached_image(member.avatar_url)
+            if image_arg:
+                return image_arg
+
             avatar_headers = await utils.retrieve_headers(member.avatar_url)
             assert not avatar_headers["CONTENT-TYPE"].endswith("gif"), "**GIF avatars are currently unsupported.**"
 
             image_bytes = await utils.download_file(member.avatar_url.replace(".webp", ".png"), bytesio=True)
             image_object = Image.open(image_bytes)
-            return ImageArg(image_object, format="PNG")
+            return await cache_image(member.avatar_url, image_object, "PNG", image_bytes)
 
         # Nope, not a mention. If we support emoji, we can progress further
         assert not url_only, "`{}` **is not a valid URL or user mention.**".format(url_or_emoji)
 
         # There was no image to get, so let's see if it's an emoji
         char = "-".join(hex(ord(c))[2:] for c in url_or_emoji)  # Convert to a hex string
+        image_arg = get_cached_image("emoji:" + char)
+        if image_arg:
+            return image_arg
+
         image_object = get_emoji(char, size=256)
         if image_object:
-            return ImageArg(image_object, format="PNG")
+            return await cache_image("emoji:" + char, image_object, "PNG")
 
         # Not an emoji, perhaps it's an emote
         match = emote_regex.match(url_or_emoji)
         if match:
+            image_arg = get_cached_image("emote:" + match.group("id"))
+            if image_arg:
+                return image_arg
+
             image_object = await get_emote(match.group("id"), message.server)
             if image_object:
-                return ImageArg(image_object, format="PNG")
+                return await cache_image("emote:" + match.group("id"), image_object, "PNG")
 
         # Alright, we're out of ideas
         raise AssertionError("`{}` **is neither a URL, a mention nor an emoji.**".format(url_or_emoji))
@@ -220,7 +371,7 @@ async def image(message: discord.Message, url_or_emoji: str):
     # Download the image and create the object
     image_bytes = await utils.download_file(url_or_emoji, bytesio=True)
     image_object = Image.open(image_bytes)
-    return ImageArg(image_object, format=image_format)
+    return await cache_image(url_or_emoji, image_object, image_format, image_bytes)
 
 
 @plugins.argument("({open}width{close}x{open}height{close} or *{open}scale{close})")
@@ -270,7 +421,7 @@ async def send_image(message: discord.Message, image_arg: ImageArg, **params):
         if image_arg.gif and gif_support:
             image_fp = BytesIO(image_arg.gif_bytes)
         else:
-            image_fp = utils.convert_image_object(image_arg.object, image_arg.format, **params)
+            image_fp = await run_image_job(utils.convert_image_object, image_arg.object, image_arg.format, **params)
     except KeyError as e:
         await client.send_message(message.channel, "Image format `{}` is unsupported.".format(e))
     else:
@@ -290,7 +441,7 @@ async def resize(message: discord.Message, image_arg: image, resolution: parse_r
         resolution = (int(w * scale), int(h * scale))
 
     # Resize and upload the image
-    image_arg.modify(Image.Image.resize, resolution, Image.NEAREST if "-nearest" in options else Image.ANTIALIAS, convert="RGBA")
+    await image_arg.modify(Image.Image.resize, resolution, Image.NEAREST if "-nearest" in options else Image.ANTIALIAS, convert="RGBA")
     await send_image(message, image_arg)
 
 
@@ -301,7 +452,7 @@ async def rotate(message: discord.Message, image_arg: image, degrees: int, *opti
         image_arg.set_extension(extension)
 
     # Rotate and upload the image
-    image_arg.modify(Image.Image.rotate, -degrees, Image.NEAREST if "-nearest" in options else Image.BICUBIC, expand=True, convert="RGBA")
+    await image_arg.modify(Image.Image.rotate, -degrees, Image.NEAREST if "-nearest" in options else Image.BICUBIC, expand=True, convert="RGBA")
     await send_image(message, image_arg)
 
 
@@ -318,7 +469,7 @@ async def jpeg(message: discord.Message, image_arg: image, *effect: utils.choice
     """ Give an image some proper jpeg artifacting.
 
     Valid effects are: `meme` """
-    image_arg.modify(to_jpg, quality, real_convert=False if "meme" in effect else True)
+    await image_arg.modify(to_jpg, quality, real_convert=False if "meme" in effect else True)
     
     await send_image(message, image_arg)
 
@@ -334,7 +485,7 @@ async def fuckify(message: discord.Message, image_arg: image, seed=None):
     # Resize to small width and height values
     new_size = [random.randint(5, 40) for _ in range(2)]
 
-    image_arg.modify([
+    await image_arg.modify([
         partial(Image.Image.resize, size=new_size, resample=Image.ANTIALIAS),
         partial(to_jpg, quality=random.randint(3, 30)),
         partial(Image.Image.resize, size=old_size, resample=Image.ANTIALIAS),
@@ -346,7 +497,7 @@ async def fuckify(message: discord.Message, image_arg: image, seed=None):
 @plugins.command()
 async def invert(message: discord.Message, image_arg: image):
     """ Invert the colors of an image. """
-    image_arg.modify(ImageOps.invert, convert="RGB")
+    await image_arg.modify(ImageOps.invert, convert="RGB")
     await send_image(message, image_arg, quality=100)
 
 
@@ -357,7 +508,7 @@ async def flip(message: discord.Message, image_arg: image, extension: str.lower=
         image_arg.set_extension(extension)
 
     # Flip the image
-    image_arg.modify(Image.Image.transpose, Image.FLIP_TOP_BOTTOM)
+    await image_arg.modify(Image.Image.transpose, Image.FLIP_TOP_BOTTOM)
     try:
         await send_image(message, image_arg)
     except IOError:
@@ -371,5 +522,5 @@ async def mirror(message: discord.Message, image_arg: image, extension: str.lowe
         image_arg.set_extension(extension)
 
     # Mirror the image
-    image_arg.modify(Image.Image.transpose, Image.FLIP_LEFT_RIGHT)
+    await image_arg.modify(Image.Image.transpose, Image.FLIP_LEFT_RIGHT)
     await send_image(message, image_arg)
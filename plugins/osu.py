@@ -31,6 +31,7 @@ Commands:
 import logging
 import re
 import traceback
+from collections import namedtuple
 from datetime import datetime, timedelta
 from enum import Enum
 from typing import List
@@ -40,7 +41,8 @@ import asyncio
 import discord
 import plugins
 from pcbot import Config, utils, Annotate
-from plugins.osulib import api, Mods, calculate_pp, can_calc_pp, ClosestPPStats
+from plugins.osulib import api, Mods, calculate_pp, calculate_pp_curve, calculate_pp_for_beatmaps, can_calc_pp, \
+    ClosestPPStats, PPQuery
 from plugins.twitchlib import twitch
 
 import json
@@ -55,7 +57,8 @@ osu_config = Config("osu", pretty=True, data=dict(
     minimum_pp_required=0,  # The minimum pp required to assign a gamemode/profile in general
     use_mentions_in_scores=True,  # Whether the bot will mention people when they set a *score*
     update_interval=30,  # The sleep time in seconds between updates
-    not_playing_skip=10,  # Number of rounds between every time someone not playing is updated
+    max_idle_doublings=6,  # Maximum number of times the update interval of someone not playing is doubled
+    max_idle_interval=60 * 30,  # The maximum time in seconds between every time someone not playing is updated
     map_event_repeat_interval=6,  # The time in hours before a map event will be treated as "new"
     profiles={},  # Profile setup as member_id: osu_id
     mode={},  # Member's game mode as member_id: gamemode_value
@@ -65,10 +68,23 @@ osu_config = Config("osu", pretty=True, data=dict(
     map_cache={},  # Cache for map events, primarily used for calculating and caching pp of the difficulties
 ))
 
+# Snapshot of the latest user data and score identities of every tracked member, used to resume tracking after restarts
+tracking_snapshot = Config("osu_tracking", data={})
+
 osu_tracking = {}  # Saves the requested data or deletes whenever the user stops playing (for comparisons)
+tracking_changed = False  # Whether any tracked user data changed since the snapshot was last saved
+notify_index = None  # Server ids with notification channels for every linked member as member_id: set; see get_notify_targets
 update_interval = osu_config.data.get("update_interval", 30)
-not_playing_skip = osu_config.data.get("not_playing_skip", 10)
+max_idle_doublings = osu_config.data.get("max_idle_doublings", 6)
+max_idle_interval = osu_config.data.get("max_idle_interval", 60 * 30)
 time_elapsed = 0  # The registered time it takes to process all information between updates (changes each update)
+score_requests_avoided = 0  # The number of top score requests skipped since the bot started
+last_score_requests_avoided = 0  # The number of top score requests skipped in the last update
+
+# Members not playing used to be updated every not_playing_skip rounds, which is replaced by backing off
+if "not_playing_skip" in osu_config.data:
+    logging.warning("The not_playing_skip option in the osu config is no longer used, as members not playing are "
+                    "backed off exponentially. See max_idle_doublings and max_idle_interval instead.")
 logging_interval = 30  # The time it takes before posting logging information to the console. TODO: setup logging
 rank_regex = re.compile(r"#\d+")
 
@@ -86,6 +102,14 @@ gamemodes = ", ".join(gm.name for gm in api.GameMode)
 
 recent_map_events = []
 event_repeat_interval = osu_config.data.get("map_event_repeat_interval", 6)
+map_event_queue = asyncio.Queue()  # Members with map events waiting to be posted by the map event workers
+map_event_backlog = {}  # Map events of every member in the queue as (event, status format), oldest first
+map_event_workers = 2  # The number of map events that can be posted at the same time
+map_event_initial_delay = 45  # The time in seconds to let the beatmap API catch up with a map event
+map_event_retry_delay = 30  # The initial time in seconds between retries when the beatmap is not found, doubled every retry
+map_event_max_retries = 6
+notify_send_limit = 10  # The maximum number of notification messages being sent at once
+notify_send_semaphore = asyncio.Semaphore(notify_send_limit)
 timestamp_pattern = re.compile(r"(\d+:\d+:\d+\s(\([0-9,]+\))?\s*)-")
 
 
@@ -105,6 +129,9 @@ class MapEvent:
         return repr(self)
 
 
+PendingMapEvent = namedtuple("PendingMapEvent", "member_id retries")
+
+
 class UpdateModes(Enum):
     """ Enums for the various notification update modes.
     Values are valid names in a tuple. """
@@ -310,6 +337,55 @@ def get_user_url(member_id: str):
         return host + "u/" + user_id
 
 
+def get_score_id(score: dict):
+    """ Return a hashable identity of a score from the osu! API. """
+    return score["beatmap_id"], score["date"], score["enabled_mods"], score["score"]
+
+
+def set_tracked_scores(member_id: str, scores: list):
+    """ Update the tracked list of scores and the set of their identities. """
+    osu_tracking[member_id]["scores"] = scores
+    osu_tracking[member_id]["score_ids"] = set(get_score_id(score) for score in scores or [])
+
+
+def restore_tracking(member_id: str):
+    """ Restore the member's latest user data and score identities from the tracking
+    snapshot, unless they have since changed their profile or game mode. """
+    snapshot = tracking_snapshot.data.get(member_id)
+    if not snapshot:
+        return
+
+    if snapshot["profile"] != osu_config.data["profiles"][member_id] or snapshot["mode"] != get_mode(member_id).value:
+        return
+
+    osu_tracking[member_id]["new"] = snapshot["new"]
+    osu_tracking[member_id]["scores"] = []
+    osu_tracking[member_id]["score_ids"] = set(tuple(score_id) for score_id in snapshot["score_ids"])
+
+
+def save_tracking():
+    """ Save a snapshot of every tracked member's latest user data and score identities.
+    Members who are not tracked yet keep their previous snapshot until they are unlinked. """
+    global tracking_changed
+
+    for member_id, data in osu_tracking.items():
+        if "new" in data and "score_ids" in data and member_id in osu_config.data["profiles"]:
+            tracking_snapshot.data[member_id] = dict(
+                profile=osu_config.data["profiles"][member_id],
+                mode=get_mode(member_id).value,
+                new=data["new"],
+                score_ids=list(data["score_ids"])
+            )
+
+    # Remove the snapshots of unlinked members
+    for member_id in list(tracking_snapshot.data):
+        if member_id not in osu_config.data["profiles"]:
+            del tracking_snapshot.data[member_id]
+
+    tracking_snapshot.save()
+    tracking_changed = False
+
+
 def is_playing(member: discord.Member):
     """ Check if a member has "osu!" in their Game name. """
     # See if the member is playing
@@ -318,7 +394,7 @@ def is_playing(member: discord.Member):
 
 async def update_user_data():
     """ Go through all registered members playing osu!, and update their data. """
-    global osu_tracking
+    global osu_tracking, tracking_changed
 
     # Go through each member playing and give them an "old" and a "new" subsection
     # for their previous and latest user data
@@ -331,14 +407,17 @@ async def update_user_data():
         if member is None:
             continue
      
-        # Add the member to tracking
+        # Add the member to tracking, resuming from the last snapshot when possible
         if member_id not in osu_tracking:
-            osu_tracking[member_id] = dict(member=member, ticks=-1)
+            osu_tracking[member_id] = dict(member=member)
+            restore_tracking(member_id)
 
-        osu_tracking[member_id]["ticks"] += 1
+        # Members tracked before the plugin was reloaded might not be scheduled yet
+        osu_tracking[member_id].setdefault("next_update", datetime.utcnow())
+        osu_tracking[member_id].setdefault("idle_updates", 0)
 
-        # Only update members not tracked ingame every nth update
-        if not is_playing(member) and osu_tracking[member_id]["ticks"] % not_playing_skip > 0:
+        # Only update members not tracked ingame when they are scheduled to
+        if not is_playing(member) and datetime.utcnow() < osu_tracking[member_id]["next_update"]:
             # Update their old data to match their new one in order to avoid duplicate posts
             if "new" in osu_tracking[member_id]:
                 osu_tracking[member_id]["old"] = osu_tracking[member_id]["new"]
@@ -368,12 +447,32 @@ async def update_user_data():
             osu_tracking[member_id]["old"] = osu_tracking[member_id]["new"]
         else:
             # If this is the first time, update the user's list of scores for later
-            osu_tracking[member_id]["scores"] = await api.get_user_best(u=profile, type="id", limit=score_request_limit, m=mode)
+            set_tracked_scores(member_id, await api.get_user_best(u=profile, type="id", limit=score_request_limit, m=mode))
 
         # Update the "new" data
         osu_tracking[member_id]["new"] = user_data
         osu_tracking[member_id]["new"]["ripple"] = True if api.ripple_pattern.match(profile) else False
 
+        if osu_tracking[member_id].get("old") != osu_tracking[member_id]["new"]:
+            tracking_changed = True
+
+        schedule_update(member_id)
+
+
+def schedule_update(member_id: str):
+    """ Schedule the next update of a member when they're not playing osu!.
+
+    Members who just played are updated every update_interval, while members
+    who haven't are backed off exponentially up to max_idle_interval seconds. """
+    data = osu_tracking[member_id]
+    if "old" in data and get_diff(data["old"], data["new"], "playcount") > 0:
+        data["idle_updates"] = 0
+    else:
+        data["idle_updates"] = min(data["idle_updates"] + 1, max_idle_doublings)
+
+    interval = min(update_interval * 2 ** data["idle_updates"], max_idle_interval)
+    data["next_update"] = datetime.utcnow() + timedelta(seconds=interval)
+
 
 async def get_new_score(member_id: str):
     """ Compare old user scores with new user scores and return the discovered
@@ -383,17 +482,23 @@ async def get_new_score(member_id: str):
     profile = osu_config.data["profiles"][member_id]
     user_scores = await api.get_user_best(u=profile, type="id", limit=score_request_limit, m=get_mode(member_id).value,
                                           request_tries=3)
+    if not user_scores:
+        return None
 
     # Compare the scores from top to bottom and try to find a new one
+    # The identities are hashed, so we stop at the first score that isn't known
+    if "score_ids" not in osu_tracking[member_id]:
+        set_tracked_scores(member_id, osu_tracking[member_id]["scores"])
+    known_score_ids = osu_tracking[member_id]["score_ids"]
     for i, score in enumerate(user_scores):
-        if score not in osu_tracking[member_id]["scores"]:
+        if get_score_id(score) not in known_score_ids:
             if i == 0:
                 logging.info(f"a #1 score was set: check plugins.osu.osu_tracking['{member_id}']['debug']")
                 osu_tracking[member_id]["debug"] = dict(scores=user_scores, old=dict(osu_tracking[member_id]["old"]), new=dict(osu_tracking[member_id]["new"]))
-            osu_tracking[member_id]["scores"] = user_scores
+            set_tracked_scores(member_id, user_scores)
 
             # Calculate the difference in pp from the score below
-            if i < len(osu_tracking[member_id]["scores"]) - 2:
+            if i < len(user_scores) - 2:
                 pp = float(score["pp"])
                 diff = pp - float(user_scores[i + 1]["pp"])
             else:
@@ -409,6 +514,13 @@ def get_diff(old, new, value):
     return float(new[value]) - float(old[value])
 
 
+def could_have_new_score(old: dict, new: dict):
+    """ Return True if the change between old and new osu! user data could
+    have been caused by a new top score. A new score always increases the
+    playcount, and a new best always changes the pp. """
+    return get_diff(old, new, "playcount") > 0 and get_diff(old, new, "pp_raw") != 0
+
+
 def get_notify_channels(server: discord.Server, data_type: str):
     """ Find the notifying channel or return the server. """
     if server.id not in osu_config.data["server"]:
@@ -421,38 +533,105 @@ def get_notify_channels(server: discord.Server, data_type: str):
             if server.get_channel(s)]
 
 
-async def get_potential_pp(score, beatmap, member: discord.Member, score_pp: float, use_acc: bool=False):
-    """ Returns the potential pp or None if it shouldn't display """
-    potential_pp = None
+def index_member(member_id: str):
+    """ Add every server with notification channels that the member is in to the notify index. """
+    server_ids = set()
+    for server_id in osu_config.data["server"]:
+        server = client.get_server(server_id)
+        if server is not None and server.get_member(member_id) is not None:
+            server_ids.add(server_id)
 
-    # Find the potentially gained pp in standard when not FC
-    if get_mode(member.id) is api.GameMode.Standard and get_update_mode(member.id) is not UpdateModes.PP \
-            and int(score["maxcombo"]) < int(beatmap["max_combo"]):
-        options = ["+" + Mods.format_mods(int(score["enabled_mods"]))]
+    notify_index[member_id] = server_ids
+
+
+def index_server(server: discord.Server):
+    """ Add every linked member of the server to the notify index. """
+    for member_id in osu_config.data["profiles"]:
+        if server.get_member(member_id) is not None:
+            notify_index.setdefault(member_id, set()).add(server.id)
+
+
+def build_notify_index():
+    """ Build the notify index from every server with notification channels. """
+    global notify_index
+    notify_index = {}
+
+    for server_id in osu_config.data["server"]:
+        server = client.get_server(server_id)
+        if server is not None:
+            index_server(server)
 
+
+def get_notify_targets(member_id: str, data_type: str):
+    """ Yield the server member and the notifying channels of every server
+    the member should be notified in. """
+    if notify_index is None:
+        build_notify_index()
+
+    for server_id in list(notify_index.get(member_id, ())):
+        server = client.get_server(server_id)
+        if server is None:
+            continue
+
+        member = server.get_member(member_id)
+        channels = get_notify_channels(server, data_type)
+        if member and channels:
+            yield member, channels
+
+
+def can_have_potential_pp(score, member: discord.Member):
+    """ Returns True if the potential pp of the score might display. Potential pp
+    is only displayed for standard scores that are not full combo. """
+    return get_mode(member.id) is api.GameMode.Standard and get_update_mode(member.id) is not UpdateModes.PP \
+        and score["perfect"] != "1"
+
+
+async def calculate_potential_pp(score, use_acc: bool=False):
+    """ Returns the pp of the score if it was a full combo, or None if it could not be calculated. """
+    beatmap_url = "https://osu.ppy.sh/b/{}".format(score["beatmap_id"])
+
+    try:
         if use_acc:
-            options.append("{acc:.2%}".format(acc=calculate_acc(api.GameMode.Standard, score, exclude_misses=True)))
-        else:
-            options.append(score["count100"] + "x100")
-            options.append(score["count50"] + "x50")
+            acc = round(calculate_acc(api.GameMode.Standard, score, exclude_misses=True) * 100, 2)
+            pp, = await calculate_pp_curve(beatmap_url, [PPQuery(acc=acc, combo=None, misses=0,
+                                                                 mods=Mods.list_mods(int(score["enabled_mods"])))])
+            return pp
 
-        try:
-            pp_stats = await calculate_pp("https://osu.ppy.sh/b/{}".format(score["beatmap_id"]), *options)
-            potential_pp = pp_stats.pp
-        except Exception as e:
-            logging.error(traceback.format_exc())
-            pass
+        options = ["+" + Mods.format_mods(int(score["enabled_mods"])),
+                   score["count100"] + "x100", score["count50"] + "x50"]
+        pp_stats = await calculate_pp(beatmap_url, *options)
+    except Exception:
+        logging.error(traceback.format_exc())
+        return None
+
+    return pp_stats.pp
 
-        # Drop this info whenever the potential pp gain is negative.
-        #     The osu! API does not provide info on sliderbreak count and missed sliderend count, which results
-        #     in faulty calculation (very often negative relatively). Therefore, I will conclude that the score
-        #     was actually an FC and has missed sliderends when the gain is negative.
-        if potential_pp - score_pp <= 0:
-            potential_pp = None
+
+def filter_potential_pp(potential_pp: float, score, beatmap, score_pp: float):
+    """ Returns the potential pp or None if it shouldn't display """
+    if potential_pp is None or int(score["maxcombo"]) >= int(beatmap["max_combo"]):
+        return None
+
+    # Drop this info whenever the potential pp gain is negative.
+    #     The osu! API does not provide info on sliderbreak count and missed sliderend count, which results
+    #     in faulty calculation (very often negative relatively). Therefore, I will conclude that the score
+    #     was actually an FC and has missed sliderends when the gain is negative.
+    if potential_pp - score_pp <= 0:
+        return None
 
     return potential_pp
 
 
+async def get_potential_pp(score, beatmap, member: discord.Member, score_pp: float, use_acc: bool=False):
+    """ Returns the potential pp or None if it shouldn't display """
+    # Find the potentially gained pp in standard when not FC
+    if not can_have_potential_pp(score, member) or int(score["maxcombo"]) >= int(beatmap["max_combo"]):
+        return None
+
+    potential_pp = await calculate_potential_pp(score, use_acc)
+    return filter_potential_pp(potential_pp, score, beatmap, score_pp)
+
+
 def get_score_name(member: discord.Member, username: str, ripple=False):
     """ Formats the username and link for scores."""
     user_url = get_user_url(member.id)
@@ -474,6 +653,8 @@ def get_formatted_score_embed(member: discord.Member, score: dict, formatted_sco
 
 async def notify_pp(member_id: str, data: dict):
     """ Notify any differences in pp and post the scores + rank/pp gained. """
+    global score_requests_avoided, last_score_requests_avoided
+
     # Only update pp when there is actually a difference
     if "old" not in data:
         return
@@ -500,37 +681,44 @@ async def notify_pp(member_id: str, data: dict):
     # If there is a score, there is also a beatmap
     if update_mode is UpdateModes.PP:
         score = None
+    elif not could_have_new_score(old, new):
+        # Changes in pp without any new plays can't be a new score, so don't bother downloading them
+        score = None
+        score_requests_avoided += 1
+        last_score_requests_avoided += 1
     else:
         score = await get_new_score(member_id)
 
     # If a new score was found, format the score
     if score:
-        beatmap = (await api.get_beatmaps(b=int(score["beatmap_id"]), m=mode.value, a=1, request_tries=3))[0]
+        # The potential pp only needs the score, so calculate it while getting the beatmap and formatting
+        potential_pp_task = None
+        if can_have_potential_pp(score, member):
+            potential_pp_task = asyncio.ensure_future(calculate_potential_pp(score))
+
+        beatmap = await api.get_beatmap(score["beatmap_id"], mode, request_tries=3)
 
         # There might not be any events
         scoreboard_rank = None
         if new["events"]:
             scoreboard_rank = api.rank_from_events(new["events"], score["beatmap_id"])
 
-        potential_pp = await get_potential_pp(score, beatmap, member, float(score["pp"]))
-
         if update_mode is UpdateModes.Minimal:
             m += await format_minimal_score(mode, score, beatmap, scoreboard_rank, member) + "\n"
         else:
             m += await format_new_score(mode, score, beatmap, scoreboard_rank, member)
 
+        if potential_pp_task is not None:
+            potential_pp = filter_potential_pp(await potential_pp_task, score, beatmap, float(score["pp"]))
+
     # Always add the difference in pp along with the ranks
     m += format_user_diff(mode, pp_diff, rank_diff, country_rank_diff, accuracy_diff, old["country"], new)
 
     # Send the message to all servers
-    for server in client.servers:
-        member = server.get_member(member_id)
-        channels = get_notify_channels(server, "score")
-        if not member or not channels:
-            continue
-
+    sends = []
+    for member, channels in get_notify_targets(member_id, "score"):
         primary_server = get_primary_server(member.id)
-        is_primary = True if primary_server is None else (True if primary_server == server.id else False)
+        is_primary = True if primary_server is None else (True if primary_server == member.server.id else False)
 
         # Format the url and the username
         name = get_score_name(member, new["username"], "ripple" in data)
@@ -543,17 +731,49 @@ async def notify_pp(member_id: str, data: dict):
             embed.description = name + "\n" + m
 
         for i, channel in enumerate(channels):
+            # In the primary server and if the user sets a score, send a mention and delete it
+            # This will only mention in the first channel of the server
+            mention = member if use_mentions_in_scores and score and i == 0 and is_primary else None
+            sends.append(send_notification(channel, embed, mention=mention))
+
+    # One failed notification should not stop the others
+    for result in await asyncio.gather(*sends, return_exceptions=True):
+        if isinstance(result, Exception):
+            logging.error("Could not send a score notification: {}".format(utils.format_exception(result)))
+
+
+async def send_notification(channel: discord.Channel, embed: discord.Embed, mention: discord.Member=None,
+                            replace: discord.Message=None):
+    """ Send a notification embed to the channel and return the message, or None if
+    we're not allowed to send messages there. Many notifications can be sent
+    concurrently, although at most notify_send_limit at a time.
+
+    :param mention: Mention this member in a message that is deleted right after.
+    :param replace: Delete this message before sending the notification.
+    """
+    async with notify_send_semaphore:
+        # The previous message might already be deleted, which shouldn't keep us from sending the new one
+        if replace is not None:
             try:
-                await client.send_message(channel, embed=embed)
-
-                # In the primary server and if the user sets a score, send a mention and delete it
-                # This will only mention in the first channel of the server
-                if use_mentions_in_scores and score and i == 0 and is_primary:
-                    mention = await client.send_message(channel, member.mention)
-                    await client.delete_message(mention)
-            except discord.Forbidden:
+                await client.delete_message(replace)
+            except discord.HTTPException:
                 pass
 
+        try:
+            msg = await client.send_message(channel, embed=embed)
+        except discord.Forbidden:
+            return None
+
+    # The mention is sent after the embed, but does not hold up the other notifications
+    if mention is not None:
+        try:
+            mention_msg = await client.send_message(channel, mention.mention)
+            await client.delete_message(mention_msg)
+        except discord.Forbidden:
+            pass
+
+    return msg
+
 
 def format_beatmapset_diffs(beatmapset: list):
     """ Format some difficulty info on a beatmapset. """
@@ -605,6 +825,7 @@ async def calculate_pp_for_beatmapset(beatmapset: list):
         osu_config.data["map_cache"][set_id] = {}
 
     cached_mapset = osu_config.data["map_cache"][set_id]
+    uncached_diffs = []
 
     for i, diff in enumerate(beatmapset):
         map_id = diff["beatmap_id"]
@@ -621,26 +842,63 @@ async def calculate_pp_for_beatmapset(beatmapset: list):
             # If it was changed, add an asterisk to the beatmap name (this is a really stupid place to do this)
             beatmapset[i]["version"] = "*" + diff["version"]
 
-        # If the diff is not cached, or was changed, calculate the pp and update the cache
-        try:
-            pp_stats = await calculate_pp(int(map_id), ignore_cache=True)
-        except ValueError:
-            logging.error(traceback.format_exc())
+        uncached_diffs.append(diff)
+
+    # If the diff is not cached, or was changed, calculate the pp and update the cache
+    # Every difficulty is downloaded concurrently and calculated in parallel
+    results = await calculate_pp_for_beatmaps(*(int(diff["beatmap_id"]) for diff in uncached_diffs))
+    for diff, pp in zip(uncached_diffs, results):
+        if pp is None:  # pp can't be calculated without oppai
             continue
 
-        beatmapset[i]["pp"] = pp_stats.pp
+        if isinstance(pp, Exception):
+            logging.error("Could not calculate pp for beatmap {}: {}".format(diff["beatmap_id"], utils.format_exception(pp)))
+            continue
+
+        diff["pp"] = pp
 
         # Cache the difficulty
-        osu_config.data["map_cache"][set_id][map_id] = {
+        cached_mapset[diff["beatmap_id"]] = {
             "md5": diff["file_md5"],
-            "pp": pp_stats.pp,
+            "pp": pp,
         }
 
     osu_config.save()
 
 
+def get_map_status_format(html: str):
+    """ Return the status format of a map event, or None if the event should be discarded. """
+    # Get and format the type of event
+    if "has submitted" in html:
+        status_format = "\U0001F310 <name> has submitted a new beatmap <title>"
+    elif "has updated" in html:
+        status_format = "\U0001F53C <name> has updated the beatmap <title>"
+    elif "has been revived" in html:
+        status_format = "\U0001F64F <title> has been revived from eternal slumber by <name>"
+    elif "has just been qualified" in html:
+        status_format = "\U0001F497 <title> by <name> has been qualified!"
+    elif "has just been ranked" in html:
+        status_format = "\u23EB <title> by <name> has been ranked!"
+    elif "has been loved" in html:
+        status_format = "\u2764 <title> by <name> has been loved!"
+    else:  # We discard any other events
+        return None
+
+    # Replace shortcuts with proper formats and add url formats
+    status_format = status_format.replace("<name>", "[**{name}**]({host}u/{user_id})")
+    status_format = status_format.replace("<title>", "[**{artist} - {title}**]({host}s/{beatmapset_id})")
+    return status_format
+
+
+def schedule_map_event(pending: PendingMapEvent, delay: float):
+    """ Put the member's map events in the map event queue after the given delay in seconds. """
+    client.loop.call_later(delay, map_event_queue.put_nowait, pending)
+
+
 async def notify_maps(member_id: str, data: dict):
-    """ Notify any map updates, such as update, resurrect and qualified. """
+    """ Queue any map updates, such as update, resurrect and qualified. The events
+    are posted by the map event workers, so that waiting for the beatmap API does
+    not hold up the update loop. """
     # Only update when there is a difference
     if "old" not in data:
         return
@@ -661,108 +919,138 @@ async def notify_maps(member_id: str, data: dict):
         # Since the events are displayed on the profile from newest to oldest, we want to post the oldest first
         events.insert(0, event)
 
-    # Format and post the events
-    for event in events:
-        html = event["display_html"]
-
-        # Get and format the type of event
-        if "has submitted" in html:
-            status_format = "\U0001F310 <name> has submitted a new beatmap <title>"
-        elif "has updated" in html:
-            status_format = "\U0001F53C <name> has updated the beatmap <title>"
-        elif "has been revived" in html:
-            status_format = "\U0001F64F <title> has been revived from eternal slumber by <name>"
-        elif "has just been qualified" in html:
-            status_format = "\U0001F497 <title> by <name> has been qualified!"
-        elif "has just been ranked" in html:
-            status_format = "\u23EB <title> by <name> has been ranked!"
-        elif "has been loved" in html:
-            status_format = "\u2764 <title> by <name> has been loved!"
-        else:  # We discard any other events
-            continue
+    events = [(event, get_map_status_format(event["display_html"])) for event in events]
+    events = [(event, status_format) for event, status_format in events if status_format is not None]
+    if not events:
+        return
+
+    # The events of a member are posted one after another by a single queued PendingMapEvent,
+    # so that they're posted in order. When the member already has one, the events are added to it
+    if member_id in map_event_backlog:
+        map_event_backlog[member_id].extend(events)
+        return
+
+    # We'll wait for a long while to let the beatmap API catch up with the change
+    map_event_backlog[member_id] = events
+    schedule_map_event(PendingMapEvent(member_id, retries=0), map_event_initial_delay)
+
+
+async def post_map_events(pending: PendingMapEvent):
+    """ Post the queued map events of a member, oldest first. When the beatmap API has not
+    caught up with an event yet, the remaining events are queued again with an exponential backoff. """
+    events = map_event_backlog.get(pending.member_id, [])
+    retries = pending.retries
+
+    while events:
+        event, status_format = events[0]
+
+        # The beatmap might not be available yet when new maps are submitted
+        try:
+            beatmapset = await api.prefetch_beatmapset(event["beatmapset_id"])
+        except:  # Retry like any other missing beatmap, so that the member's events are not left behind
+            logging.error(traceback.format_exc())
+            beatmapset = None
+
+        if not beatmapset:
+            if retries < map_event_max_retries:
+                schedule_map_event(pending._replace(retries=retries + 1), map_event_retry_delay * 2 ** retries)
+                return
 
-        # Replace shortcuts with proper formats and add url formats
-        if status_format:
-            status_format = status_format.replace("<name>", "[**{name}**]({host}u/{user_id})")
-            status_format = status_format.replace("<title>", "[**{artist} - {title}**]({host}s/{beatmapset_id})")
-
-        # We'll sleep for a long while to let the beatmap API catch up with the change
-        await asyncio.sleep(45)
-
-        # Try returning the beatmap info 6 times with a span of a minute
-        # This might be needed when new maps are submitted
-        for _ in range(6):
-            beatmapset = await api.get_beatmaps(s=event["beatmapset_id"])
-            if beatmapset:
-                break
-            await asyncio.sleep(60)
-        else:
             # well shit
+            logging.info("Gave up retrieving beatmapset {} for a map event".format(event["beatmapset_id"]))
+            events.pop(0)
+            retries = 0
             continue
 
-        # Calculate (or retrieve cached info) the pp for every difficulty of this mapset
+        events.pop(0)
+        retries = 0
         try:
-            await calculate_pp_for_beatmapset(beatmapset)
-        except ValueError:
+            await post_map_event(pending.member_id, event, status_format, beatmapset)
+        except:
             logging.error(traceback.format_exc())
 
-        new_event = MapEvent(html)
-        prev = discord.utils.get(recent_map_events, text=html)
-        to_delete = []
-        
-        if prev:
-            recent_map_events.remove(prev)
+    map_event_backlog.pop(pending.member_id, None)
 
-            if prev.time_created + timedelta(hours=event_repeat_interval) > new_event.time_created:
-                to_delete = prev.messages
-                new_event.count = prev.count + 1
-                new_event.time_created = prev.time_created
-        
-        # Always append the new event to the recent list
-        recent_map_events.append(new_event)
 
-        # Send the message to all servers
-        for server in client.servers:
-            member = server.get_member(member_id)
-            channels = get_notify_channels(server, "map")  # type: list
+async def post_map_event(member_id: str, event: dict, status_format: str, beatmapset: list):
+    """ Format and post a map event. """
+    html = event["display_html"]
 
-            if not member or not channels:
-                continue
+    # Calculate (or retrieve cached info) the pp for every difficulty of this mapset
+    try:
+        await calculate_pp_for_beatmapset(beatmapset)
+    except ValueError:
+        logging.error(traceback.format_exc())
+
+    new_event = MapEvent(html)
+    prev = discord.utils.get(recent_map_events, text=html)
+    to_delete = []
 
-            for channel in channels:
-                # Do not format difficulties when minimal (or pp) information is specified
-                update_mode = get_update_mode(member_id)
-                embed = format_map_status(member, status_format, beatmapset, update_mode is not UpdateModes.Full)
-                if new_event.count > 1:
-                    embed.set_footer(text="updated {} times since".format(new_event.count))
-                    embed.timestamp = new_event.time_created
-                
-                # Delete the previous message if there is one
-                if to_delete:
-                    delete_msg = discord.utils.get(to_delete, channel=channel)
-                    await client.delete_message(delete_msg)
-                    to_delete.remove(delete_msg)
-
-                try:
-                    msg = await client.send_message(channel, embed=embed)
-                except discord.errors.Forbidden:
-                    pass
-                else:
-                    new_event.messages.append(msg)
+    if prev:
+        recent_map_events.remove(prev)
+
+        if prev.time_created + timedelta(hours=event_repeat_interval) > new_event.time_created:
+            to_delete = prev.messages
+            new_event.count = prev.count + 1
+            new_event.time_created = prev.time_created
+
+    # Always append the new event to the recent list
+    recent_map_events.append(new_event)
+
+    # Send the message to all servers
+    # Do not format difficulties when minimal (or pp) information is specified
+    update_mode = get_update_mode(member_id)
+    sends = []
+    for member, channels in get_notify_targets(member_id, "map"):
+        embed = format_map_status(member, status_format, beatmapset, update_mode is not UpdateModes.Full)
+        if new_event.count > 1:
+            embed.set_footer(text="updated {} times since".format(new_event.count))
+            embed.timestamp = new_event.time_created
+
+        for channel in channels:
+            # Delete the previous message if there is one
+            delete_msg = discord.utils.get(to_delete, channel=channel)
+            if delete_msg:
+                to_delete.remove(delete_msg)
+
+            sends.append(send_notification(channel, embed, replace=delete_msg))
+
+    # One failed notification should not stop the others, or keep the sent messages from being stored
+    for msg in await asyncio.gather(*sends, return_exceptions=True):
+        if isinstance(msg, Exception):
+            logging.error("Could not send a map notification: {}".format(utils.format_exception(msg)))
+        elif msg is not None:
+            new_event.messages.append(msg)
+
+
+async def map_event_worker():
+    """ Post map events from the map event queue. """
+    while not client.loop.is_closed():
+        pending = await map_event_queue.get()
+
+        try:
+            await post_map_events(pending)
+        except:
+            logging.error(traceback.format_exc())
 
 
 async def on_ready():
     """ Handle every event. """
-    global time_elapsed
+    global time_elapsed, last_score_requests_avoided
 
     # Notify the owner when they have not set their API key
     if osu_config.data["key"] == "change to your api key":
         logging.warning("osu! functionality is unavailable until an API key is provided (config/osu.json)")
 
+    # Map events are posted separately, as they might wait for the beatmap API for a long time
+    for _ in range(map_event_workers):
+        client.loop.create_task(map_event_worker())
+
     while not client.loop.is_closed():
         try:
             await asyncio.sleep(update_interval, loop=client.loop)
             started = datetime.now()
+            last_score_requests_avoided = 0
 
             # First, update every user's data
             await update_user_data()
@@ -775,10 +1063,13 @@ async def on_ready():
             for member_id, data in osu_tracking.items():
                 await notify_pp(member_id, data)
 
-            # Check for any differences in the users' events and post about map updates
-            # NOTE: the same applies to this now. These can't be concurrent as they also calculate pp.
+            # Check for any differences in the users' events and queue map updates
             for member_id, data in osu_tracking.items():
                 await notify_maps(member_id, data)
+
+            # Save the tracking snapshot so that we can resume tracking after a restart
+            if tracking_changed:
+                save_tracking()
         except aiohttp.ClientOSError as e:
             logging.error(str(e))
         except:
@@ -791,16 +1082,62 @@ async def on_ready():
             time_elapsed = (datetime.now() - started).total_seconds()
 
 
+async def save(plugins):
+    """ Save the tracking snapshot. """
+    save_tracking()
+
+
 async def on_reload(name: str):
     """ Preserve the tracking cache. """
-    global osu_tracking, recent_map_events
+    global osu_tracking, recent_map_events, map_event_queue, map_event_backlog
     local_tracking = osu_tracking
     local_events = recent_map_events
+    local_queue = map_event_queue
+    local_backlog = map_event_backlog
 
     await plugins.reload(name)
 
     osu_tracking = local_tracking
     recent_map_events = local_events
+    map_event_queue = local_queue
+    map_event_backlog = local_backlog
+
+
+@plugins.event()
+async def on_member_join(member: discord.Member):
+    """ Add newly joined linked members to the notify index. """
+    if notify_index is not None and member.id in osu_config.data["profiles"] \
+            and member.server.id in osu_config.data["server"]:
+        notify_index.setdefault(member.id, set()).add(member.server.id)
+
+
+@plugins.event()
+async def on_member_remove(member: discord.Member):
+    """ Remove members leaving a server from the notify index. """
+    if notify_index is not None and member.id in notify_index:
+        notify_index[member.id].discard(member.server.id)
+
+
+@plugins.event()
+async def on_server_join(server: discord.Server):
+    """ Add the linked members of a server that added the bot back to the notify index. """
+    if notify_index is not None and server.id in osu_config.data["server"]:
+        index_server(server)
+
+
+@plugins.event()
+async def on_server_available(server: discord.Server):
+    """ Add the linked members of a server that was unavailable to the notify index. """
+    if notify_index is not None and server.id in osu_config.data["server"]:
+        index_server(server)
+
+
+@plugins.event()
+async def on_server_remove(server: discord.Server):
+    """ Remove the server from the notify index. """
+    if notify_index is not None:
+        for server_ids in notify_index.values():
+            server_ids.discard(server.id)
 
 
 def get_timestamps_with_url(content: str):
@@ -913,6 +1250,9 @@ async def link(message: discord.Message, name: Annotate.LowerContent):
     osu_config.data["mode"][message.author.id] = mode.value
     osu_config.data["primary_server"][message.author.id] = message.server.id
     osu_config.save()
+
+    if notify_index is not None:
+        index_member(message.author.id)
     await client.say(message, "Set your osu! profile to `{}`.".format(osu_user["username"]))
 
 
@@ -930,6 +1270,9 @@ async def unlink(message: discord.Message, member: discord.Member=Annotate.Self)
     # Unlink the given member (usually the message author)
     del osu_config.data["profiles"][member.id]
     osu_config.save()
+
+    if notify_index is not None:
+        notify_index.pop(member.id, None)
     await client.say(message, "Unlinked **{}'s** osu! profile.".format(member.name))
 
 
@@ -1073,7 +1416,8 @@ async def recent(message: discord.Message, member: Annotate.Member=Annotate.Self
     assert scores, "Found no recent score."
 
     score = scores[0]
-    beatmap = (await api.get_beatmaps(b=int(score["beatmap_id"]), m=mode.value, a=1, request_tries=3))[0]
+    beatmap = await api.get_beatmap(score["beatmap_id"], mode, request_tries=3)
+    assert beatmap, "Could not find the beatmap of the score."
 
     embed = await create_score_embed_with_pp(member, score, beatmap, mode)
     await client.send_message(message.channel, embed=embed)
@@ -1107,7 +1451,8 @@ async def score(message: discord.Message, beatmap_url: str):
     # Add the beatmap_id as it is not provided by the get_scores API endpoint
     score["beatmap_id"] = beatmap_info.beatmap_id
 
-    beatmap = (await api.get_beatmaps(b=beatmap_info.beatmap_id, m=mode.value, limit=1))[0]
+    beatmap = await api.get_beatmap(beatmap_info.beatmap_id, mode)
+    assert beatmap, "Could not find the beatmap."
 
     embed = await create_score_embed_with_pp(message.author, score, beatmap, mode)
     await client.send_message(message.channel, embed=embed)
@@ -1149,6 +1494,9 @@ async def scores(message: discord.Message, *channels: discord.Channel):
     init_server_config(message.server)
     osu_config.data["server"][message.server.id]["score-channels"] = list(c.id for c in channels)
     osu_config.save()
+
+    if notify_index is not None:
+        index_server(message.server)
     await client.say(message, "**Notifying scores in**: {}".format(
         utils.format_objects(*channels, sep=" ") or "no channels"))
 
@@ -1159,6 +1507,9 @@ async def maps(message: discord.Message, *channels: discord.Channel):
     init_server_config(message.server)
     osu_config.data["server"][message.server.id]["map-channels"] = list(c.id for c in channels)
     osu_config.save()
+
+    if notify_index is not None:
+        index_server(message.server)
     await client.say(message, "**Notifying map updates in**: {}".format(
         utils.format_objects(*channels, sep=" ") or "no channels"))
 
@@ -1167,10 +1518,12 @@ async def maps(message: discord.Message, *channels: discord.Channel):
 async def debug(message: discord.Message):
     """ Display some debug info. """
     await client.say(message, "Sent `{}` requests since the bot started (`{}`).\n"
+                              "Avoided `{}` top score requests (`{}` last update).\n"
                               "Spent `{:.3f}` seconds last update.\n"
                               "Members registered as playing: {}\n"
                               "Total members tracked: `{}`".format(
         api.requests_sent, client.time_started.ctime(),
+        score_requests_avoided, last_score_requests_avoided,
         time_elapsed,
         utils.format_objects(*[d["member"] for d in osu_tracking.values() if is_playing(d["member"])], dec="`"),
         len(osu_tracking)
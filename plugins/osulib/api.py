@@ -4,10 +4,14 @@
     request functions.
 """
 
+import asyncio
 import logging
 import re
+import time
 from collections import namedtuple
+from copy import deepcopy
 from enum import Enum
+from functools import lru_cache
 
 from pcbot import utils
 
@@ -15,6 +19,14 @@ from pcbot import utils
 api_url = "https://osu.ppy.sh/api/"
 api_key = ""
 requests_sent = 0
+requests_in_flight = {}  # Requests currently being sent as (url, params): asyncio.Future
+
+# Beatmap metadata cache as (beatmap_id, mode value): (expires, beatmap)
+beatmap_cache = {}
+beatmap_cache_size = 2000
+ranked_beatmap_cache_time = 60 * 60 * 24 * 7  # Ranked, approved and loved maps rarely change
+pending_beatmap_cache_time = 60 * 10
+ranked_statuses = ("1", "2", "4")
 
 ripple_url = "https://ripple.moe/api/"
 ripple_pattern = re.compile(r"ripple:\s*(?P<data>.+)")
@@ -98,10 +110,14 @@ class Mods(Enum):
     @classmethod
     def list_mods(cls, bitwise: int):
         """ Return a list of mod enums from the given bitwise (enabled_mods in the osu! API) """
-        bin_str = str(bin(bitwise))[2:]
-        bin_list = [int(d) for d in bin_str[::-1]]
-        mods_bin = (pow(2, i) for i, d in enumerate(bin_list) if d == 1)
-        mods = [cls(mod) for mod in mods_bin]
+        mods = []
+
+        # Go through the set bits from lowest to highest
+        while bitwise:
+            bit = bitwise & -bitwise
+            if bit in mods_by_value:
+                mods.append(mods_by_value[bit])
+            bitwise ^= bit
 
         # Manual checks for multiples
         if Mods.DT in mods and Mods.NC in mods:
@@ -116,17 +132,52 @@ class Mods(Enum):
         mods is either a bitwise or a list of mod enums.
         """
         if type(mods) is int:
-            mods = cls.list_mods(mods)
+            return format_mods_bitwise(mods)
         assert type(mods) is list
 
         return "".join((mod.name for mod in mods) if mods else ["Nomod"])
 
 
-def def_section(api_name: str, first_element: bool=False):
-    """ Add a section using a template to simplify adding API functions. """
-    async def template(url=api_url, request_tries: int=1, **params):
+# Lookup tables for every mod by their value and by their lowercase name
+mods_by_value = {mod.value: mod for mod in Mods}
+mods_by_name = {mod.name.lower(): mod for mod in Mods}
+
+
+@lru_cache(maxsize=256)
+def format_mods_bitwise(bitwise: int):
+    """ Return a string with the mods of the bitwise in a sorted format, such as DTHD. """
+    return Mods.format_mods(Mods.list_mods(bitwise))
+
+
+def def_section(api_name: str, first_element: bool=False, on_response=None):
+    """ Add a section using a template to simplify adding API functions.
+
+    Identical requests sent at the same time share a single request.
+
+    :param on_response: A function called with the json and the params of every response, e.g. for caching.
+    """
+    async def request(url: str, request_tries: int, params: dict):
         global requests_sent
 
+        # Download using a URL of the given API function name
+        for i in range(request_tries):
+            requests_sent += 1
+            try:
+                json = await utils.download_json(url + api_name, **params)
+            except ValueError as e:
+                logging.warning("ValueError Calling {}: {}".format(url + api_name, e))
+            else:
+                if json is not None:
+                    break
+        else:
+            return None
+
+        if on_response is not None:
+            on_response(json, params)
+
+        return json
+
+    async def template(url=api_url, request_tries: int=1, **params):
         # Convert ripple id properly and change the url
         if "u" in params:
             ripple = ripple_pattern.match(params["u"])
@@ -138,18 +189,19 @@ def def_section(api_name: str, first_element: bool=False):
         if url == api_url and "k" not in params:
             params["k"] = api_key
 
-        # Download using a URL of the given API function name
-        for i in range(request_tries):
-            try:
-                json = await utils.download_json(url + api_name, **params)
-            except ValueError as e:
-                logging.warning("ValueError Calling {}: {}".format(url + api_name, e))
-            else:
-                requests_sent += 1
-
-                if json is not None:
-                    break
+        # Wait for an identical request if one is already being sent
+        key = (url + api_name, tuple(sorted((k, str(v)) for k, v in params.items())))
+        if key in requests_in_flight:
+            future = requests_in_flight[key]
         else:
+            future = asyncio.ensure_future(request(url, request_tries, params))
+            requests_in_flight[key] = future
+            future.add_done_callback(lambda f: requests_in_flight.pop(key, None))
+
+        # Every caller gets their own copy, since the response is often modified
+        json = deepcopy(await asyncio.shield(future))
+
+        if json is None:
             return None
 
         # Unless we want to extract the first element, return the entire object (usually a list)
@@ -166,7 +218,8 @@ def def_section(api_name: str, first_element: bool=False):
 
 
 # Define all osu! API requests using the template
-get_beatmaps = def_section("get_beatmaps")
+get_beatmaps = def_section("get_beatmaps", on_response=lambda json, params: cache_beatmaps(
+    json, GameMode(int(params["m"])) if "m" in params else None))
 get_user = def_section("get_user", first_element=True)
 get_scores = def_section("get_scores")
 get_user_best = def_section("get_user_best")
@@ -174,6 +227,62 @@ get_user_recent = def_section("get_user_recent")
 get_match = def_section("get_match", first_element=True)
 get_replay = def_section("get_replay")
 
+def cache_beatmaps(beatmaps: list, mode: GameMode=None):
+    """ Add beatmaps to the beatmap cache, which is done for every get_beatmaps() response.
+    Ranked and loved beatmaps are cached for a long time, while any other status is only
+    cached for a short while.
+
+    :param beatmaps: A list of beatmap dicts.
+    :param mode: The mode given to get_beatmaps(), or None to use the mode of each beatmap.
+    """
+    now = time.time()
+    for beatmap in beatmaps or []:
+        cache_time = ranked_beatmap_cache_time if beatmap["approved"] in ranked_statuses else pending_beatmap_cache_time
+        key = (str(beatmap["beatmap_id"]), mode.value if mode is not None else int(beatmap["mode"]))
+
+        # Reinsert the beatmap so that the cache is ordered from oldest to newest
+        beatmap_cache.pop(key, None)
+        beatmap_cache[key] = (now + cache_time, dict(beatmap))
+
+    # Remove the oldest beatmaps when the cache is full
+    while len(beatmap_cache) > beatmap_cache_size:
+        del beatmap_cache[next(iter(beatmap_cache))]
+
+
+async def get_beatmap(beatmap_id, mode: GameMode=GameMode.Standard, request_tries: int=1):
+    """ Return the beatmap dict of the given id in the given mode (including converted
+    maps), or None if it does not exist. The beatmap is cached, see cache_beatmaps().
+
+    :param beatmap_id: The beatmap id as str or int.
+    :param mode: The GameMode to lookup.
+    :param request_tries: The number of tries when requesting the beatmap.
+    """
+    key = (str(beatmap_id), mode.value)
+    if key in beatmap_cache:
+        expires, beatmap = beatmap_cache[key]
+        if expires > time.time():
+            return dict(beatmap)
+
+        del beatmap_cache[key]
+
+    # The response is added to the beatmap cache by get_beatmaps
+    beatmaps = await get_beatmaps(b=beatmap_id, m=mode.value, a=1, limit=1, request_tries=request_tries)
+    if not beatmaps:
+        return None
+
+    return beatmaps[0]
+
+
+async def prefetch_beatmapset(beatmapset_id, mode: GameMode=None):
+    """ Download every difficulty of the beatmapset in one request and add them to the beatmap cache.
+
+    :param beatmapset_id: The beatmapset id as str or int.
+    :param mode: The GameMode to lookup (including converted maps), or None for only the original modes.
+    """
+    params = dict(m=mode.value, a=1) if mode is not None else {}
+    return await get_beatmaps(s=beatmapset_id, **params)
+
+
 beatmap_url_pattern_v1 = re.compile(r"https?://(osu|old)\.ppy\.sh/(?P<type>[bs])/(?P<id>\d+)(?:\?m=(?P<mode>\d))?")
 beatmap_url_pattern_v2 = re.compile(r"https?://osu\.ppy\.sh/beatmapsets/(?P<beatmapset_id>\d+)(?:#(?P<mode>\w+)/(?P<beatmap_id>\d+))?")
 
@@ -272,7 +381,7 @@ async def beatmapset_from_url(url: str):
 
         beatmapset_id = difficulty[0]["beatmapset_id"]
 
-    beatmapset = await get_beatmaps(s=beatmapset_id)
+    beatmapset = await prefetch_beatmapset(beatmapset_id)
 
     # Also make sure we get the beatmap
     if not beatmapset:
@@ -3,56 +3,64 @@
 import re
 from collections import namedtuple
 
-from .api import Mods
+from .api import mods_by_name
 
 
-Argument = namedtuple("Argument", "pattern kwarg_pattern type default")
+Argument = namedtuple("Argument", "pattern type default")
 mods_names = re.compile(r"\w{2}")
-kwarg = r"{}=(?P<value>\S+)"
+kwarg = r"{}=(\S+)"
+kwarg_suffix = "__kwarg"
 
 
 class RegexArgumentParser:
-    """ Create a simple orderless regex argument parser. """
+    """ Create a simple orderless regex argument parser.
+
+    Every argument pattern is compiled into a single pattern of named
+    alternatives, so that each user argument is only matched once. """
     def __init__(self):
         self.arguments = {}
+        self.pattern = None
+        self.Namespace = None
 
     def add(self, name, pattern, type, default=None):
         """ Adds an argument. The pattern must have a group. """
-        self.arguments[name] = Argument(pattern=re.compile(pattern, flags=re.IGNORECASE),
-                                        kwarg_pattern=re.compile(kwarg.format(name)),
-                                        type=type, default=default)
+        self.arguments[name] = Argument(pattern=pattern, type=type, default=default)
+        self.compile()
+
+    def compile(self):
+        """ Compile the patterns of every argument and create the Namespace type.
+        The patterns are tried in the order they were added, followed by their
+        kwarg patterns (e.g acc=99.32 instead of 99.32%). """
+        alternatives = ["(?P<{}>(?i:{}))".format(name, arg.pattern) for name, arg in self.arguments.items()]
+        alternatives.extend("(?P<{}{}>{})".format(name, kwarg_suffix, kwarg.format(name)) for name in self.arguments)
+        self.pattern = re.compile("|".join(alternatives))
+        self.Namespace = namedtuple("Namespace", " ".join(self.arguments.keys()))
 
     def parse(self, *args):
         """ Parse arguments.
 
         :raise ValueError: An argument is invalid.
         """
-        Namespace = namedtuple("Namespace", " ".join(self.arguments.keys()))
         _namespace = {name: arg.default for name, arg in self.arguments.items()}
+        assigned = set()
 
         # Go through all arguments and find a match
         for user_arg in args:
-            for name, arg in self.arguments.items():
-                # Skip any already assigned arguments
-                if _namespace[name] is not arg.default:
-                    continue
-
-                # Assign the arguments on match and break the lookup
-                match = arg.pattern.fullmatch(user_arg, )
-                if match:
-                    _namespace[name] = arg.type(match.group(1))
-                    break
-
-                # Check for kwarg patterns (e.g acc=99.32 instead of 99.32%)
-                match = arg.kwarg_pattern.fullmatch(user_arg)
-                if match:
-                    _namespace[name] = arg.type(match.group("value"))
-                    break
-            else:
+            match = self.pattern.fullmatch(user_arg)
+            if not match:
+                raise ValueError("{} is an invalid argument.".format(user_arg))
+
+            # The value is the first group of the matched argument pattern
+            group = match.lastgroup
+            name = group[:-len(kwarg_suffix)] if group.endswith(kwarg_suffix) else group
+            if name in assigned:
                 raise ValueError("{} is an invalid argument.".format(user_arg))
 
+            assigned.add(name)
+            _namespace[name] = self.arguments[name].type(match.group(self.pattern.groupindex[group] + 1))
+
         # Return the complete Namespace namedtuple
-        return Namespace(**_namespace)
+        return self.Namespace(**_namespace)
 
 
 def mods(s: str):
@@ -62,14 +70,11 @@ def mods(s: str):
 
     # Find and add all identified mods
     for name in names:
-        for mod in Mods:
-            # Skip duplicate mods
-            if mod in mod_list:
-                continue
-
-            if mod.name.lower() == name.lower():
-                mod_list.append(mod)
-                break
+        mod = mods_by_name.get(name.lower())
+
+        # Skip unknown and duplicate mods
+        if mod is not None and mod not in mod_list:
+            mod_list.append(mod)
 
     return mod_list
 
@@ -2,8 +2,12 @@
     https://github.com/Francesco149/oppai-ng
 """
 
+import multiprocessing
 import os
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
 import logging
 
 from pcbot import utils
@@ -22,10 +26,15 @@ host = "https://osu.ppy.sh/"
 CachedBeatmap = namedtuple("CachedBeatmap", "url_or_id beatmap")
 PPStats = namedtuple("PPStats", "pp stars artist title version ar od hp cs")
 ClosestPPStats = namedtuple("ClosestPPStats", "acc pp stars artist title version")
+PPQuery = namedtuple("PPQuery", "acc combo misses mods")
 
 plugin_path = "plugins/osulib/"
 beatmap_path = os.path.join(plugin_path, "map.osu")
 cached_beatmap = CachedBeatmap(url_or_id=None, beatmap=None)
+closest_pp_precision = .01  # The accuracy precision in percent when searching for the closest pp
+pp_workers = 4  # The maximum number of worker processes used when calculating pp for several maps at once
+pp_executor = None  # Created on first use by get_pp_executor()
+pp_timeout = 60  # The number of seconds to wait for the pp of several maps
 
 
 async def is_osu_file(url: str):
@@ -34,9 +43,12 @@ async def is_osu_file(url: str):
     return "text/plain" in headers.get("Content-Type", "") and ".osu" in headers.get("Content-Disposition", "")
 
 
-async def download_beatmap(beatmap_url_or_id):
+async def download_beatmap(beatmap_url_or_id, save: bool = True):
     """ Download the .osu file of the beatmap with the given url, and save it to beatmap_path.
     :param beatmap_url_or_id: beatmap_url as str or the id as int
+    :param save: When false, the file is not written to beatmap_path, which is required when
+                 downloading several beatmaps concurrently
+    :return: The contents of the .osu file as str
     """
     # Parse the url and find the link to the .osu file
     try:
@@ -58,15 +70,19 @@ async def download_beatmap(beatmap_url_or_id):
     if not beatmap_file:
         raise ValueError("The given URL is invalid.")
 
-    with open(beatmap_path, "wb") as f:
-        f.write(beatmap_file)
+    if save:
+        with open(beatmap_path, "wb") as f:
+            f.write(beatmap_file)
 
     # one map apparently had a /ufeff at the very beginning of the file???
     # https://osu.ppy.sh/b/1820921
-    if not beatmap_file.decode().strip("\ufeff \t").startswith("osu file format"):
-        logging.error("Invalid file received from {}\nCheck {}".format(file_url, beatmap_path))
+    beatmap = beatmap_file.decode("utf-8")
+    if not beatmap.strip("\ufeff \t").startswith("osu file format"):
+        logging.error("Invalid file received from {}{}".format(file_url, "\nCheck " + beatmap_path if save else ""))
         raise ValueError("Could not download the .osu file.")
 
+    return beatmap
+
 
 async def parse_map(beatmap_url_or_id, ignore_cache: bool = False):
     """ Download and parse the map with the given url or id, or return a newly parsed cached version.
@@ -170,6 +186,127 @@ async def calculate_pp(beatmap_url_or_id, *options, ignore_cache: bool = False):
     return PPStats(pp, totalstars, artist, title, version, ar, od, hp, cs)
 
 
+async def calculate_pp_curve(beatmap_url_or_id, queries, ignore_cache: bool = False):
+    """ Return a list of pp values from this beatmap, one for every query. The map is only
+    parsed once, and every query is evaluated on the same oppai handle.
+
+    Each query is a PPQuery or a tuple of (acc, combo, misses, mods), where acc is in percent,
+    combo is None for full combo and mods is either a bitmask or a list of api.Mods.
+
+    :param beatmap_url_or_id: beatmap_url as str or the id as int
+    :param queries: An iterable of PPQuery
+    :param ignore_cache: When true, the .osu will always be downloaded
+    """
+    beatmap = await parse_map(beatmap_url_or_id, ignore_cache=ignore_cache)
+    ez = ezpp_new()
+    ezpp_set_autocalc(ez, 1)
+    ezpp_data_dup(ez, beatmap, len(beatmap.encode(errors="replace")))
+
+    results = []
+    try:
+        for query in queries:
+            acc, combo, misses, mods = PPQuery(*query)
+            if type(mods) is not int:
+                mods = sum(mod.value for mod in mods) if mods else 0
+
+            # The accuracy is set without misses, in the same order as calculate_pp(), since the
+            # number of 100s oppai picks for the accuracy depends on the misses of the last query
+            ezpp_set_nmiss(ez, 0)
+            ezpp_set_accuracy_percent(ez, acc)
+            ezpp_set_combo(ez, combo if combo is not None else -1)
+
+            # Changing the mods recalculates the difficulty, so only do it when needed
+            if ezpp_mods(ez) != mods:
+                ezpp_set_mods(ez, mods)
+
+            ezpp_set_nmiss(ez, misses or 0)
+            results.append(ezpp_pp(ez))
+    finally:
+        ezpp_free(ez)
+
+    return results
+
+
+def calculate_pp_from_data(beatmap: str):
+    """ Return the nomod SS pp of the given .osu file contents. This is a blocking
+    function meant to be run in the pp executor.
+
+    :param beatmap: The contents of a .osu file as str
+    """
+    ez = ezpp_new()
+    ezpp_set_autocalc(ez, 1)
+    ezpp_data_dup(ez, beatmap, len(beatmap.encode(errors="replace")))
+    pp = ezpp_pp(ez)
+    ezpp_free(ez)
+    return pp
+
+
+def get_pp_executor():
+    """ Return the process pool used for calculating pp of several maps at once. The workers are
+    started by a fork server rather than forked from the bot, as the bot runs several threads.
+    Python versions before 3.7 can't choose how the workers are started. """
+    global pp_executor
+    if pp_executor is None:
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        try:
+            pp_executor = ProcessPoolExecutor(max_workers=pp_workers,
+                                              mp_context=multiprocessing.get_context(start_method))
+        except TypeError:
+            pp_executor = ProcessPoolExecutor(max_workers=pp_workers)
+
+    return pp_executor
+
+
+def shutdown_pp_executor(executor: ProcessPoolExecutor):
+    """ Stop the workers of the executor, so that the next maps are calculated by new workers. """
+    global pp_executor
+    if pp_executor is executor:
+        pp_executor = None
+    executor.shutdown(wait=False)
+
+
+async def calculate_pp_for_beatmaps(*beatmap_ids):
+    """ Download every beatmap concurrently and calculate their nomod SS pp in parallel
+    worker processes. The returned list has the pp of each beatmap in the given order,
+    or the exception raised while downloading or calculating it, or asyncio.TimeoutError
+    when it took longer than pp_timeout seconds. Every pp is None when oppai is not installed.
+
+    :param beatmap_ids: The id of every beatmap as int
+    """
+    if not can_calc_pp or not beatmap_ids:
+        return [None] * len(beatmap_ids)
+
+    beatmaps = await asyncio.gather(*(download_beatmap(beatmap_id, save=False) for beatmap_id in beatmap_ids),
+                                    return_exceptions=True)
+
+    loop = asyncio.get_event_loop()
+    downloaded = [beatmap for beatmap in beatmaps if not isinstance(beatmap, Exception)]
+    executor = get_pp_executor()
+    try:
+        futures = [loop.run_in_executor(executor, calculate_pp_from_data, beatmap) for beatmap in downloaded]
+    except BrokenProcessPool:  # A worker crashed since the last maps were calculated
+        shutdown_pp_executor(executor)
+        executor = get_pp_executor()
+        futures = [loop.run_in_executor(executor, calculate_pp_from_data, beatmap) for beatmap in downloaded]
+    done, pending = await asyncio.wait(futures, timeout=pp_timeout) if futures else (set(), set())
+
+    # Workers that didn't finish in time may be stuck, and workers that crashed break the pool
+    if pending or any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+        shutdown_pp_executor(executor)
+
+    results = []
+    for future in futures:
+        if future in pending:
+            future.cancel()
+            results.append(asyncio.TimeoutError("Calculating pp took longer than {} seconds".format(pp_timeout)))
+        else:
+            results.append(future.exception() or future.result())
+    results = iter(results)
+
+    # Merge the calculated pp with any exception raised when downloading
+    return [beatmap if isinstance(beatmap, Exception) else next(results) for beatmap in beatmaps]
+
+
 async def find_closest_pp(beatmap, args):
     """ Find the accuracy required to get the given amount of pp from this map. """
     if not can_calc_pp:
@@ -181,32 +318,31 @@ async def find_closest_pp(beatmap, args):
     # Set mod bitmask
     mods_bitmask = sum(mod.value for mod in args.mods) if args.mods else 0
 
-    # Define a partial command for easily setting the pp value by 100s count
-    def calc(accuracy: float):
-        # Set score version
-        ezpp_set_score_version(ez, args.score_version)
-
-        # Set number of misses
-        ezpp_set_nmiss(ez, args.misses)
+    # Set score version
+    ezpp_set_score_version(ez, args.score_version)
 
-        # Apply mods
-        ezpp_set_mods(ez, mods_bitmask)
+    # Set number of misses
+    ezpp_set_nmiss(ez, args.misses)
 
-        # Set accuracy
-        ezpp_set_accuracy_percent(ez, accuracy)
+    # Apply mods
+    ezpp_set_mods(ez, mods_bitmask)
 
-        # Set args if needed
-        # TODO: cs doesn't seem to actually be applied in calculation, although
-        # it works in the native C version of oppai-ng
-        if args.cs:
-            ezpp_set_base_cs(ez, args.cs)
-        if args.ar:
-            ezpp_set_base_ar(ez, args.ar)
-        if args.hp:
-            ezpp_set_base_hp(ez, args.hp)
-        if args.od:
-            ezpp_set_base_od(ez, args.od)
+    # Set args if needed
+    # TODO: cs doesn't seem to actually be applied in calculation, although
+    # it works in the native C version of oppai-ng
+    if args.cs:
+        ezpp_set_base_cs(ez, args.cs)
+    if args.ar:
+        ezpp_set_base_ar(ez, args.ar)
+    if args.hp:
+        ezpp_set_base_hp(ez, args.hp)
+    if args.od:
+        ezpp_set_base_od(ez, args.od)
 
+    # Define a partial command for easily setting the pp value by accuracy. Only the accuracy
+    # changes, since changing the other settings makes oppai calculate the difficulty again
+    def calc(accuracy: float):
+        ezpp_set_accuracy_percent(ez, accuracy)
         return ezpp_pp(ez)
 
     # Find the smallest possible value oppai is willing to give
@@ -215,22 +351,22 @@ async def find_closest_pp(beatmap, args):
         raise ValueError("The given pp value is too low (oppai gives **{:.02f}pp** at **0% acc**).".format(min_pp))
 
     # Calculate the max pp value by using 100% acc
-    previous_pp = calc(accuracy=100.0)
+    max_pp = calc(accuracy=100.0)
 
-    if args.pp >= previous_pp:
-        raise ValueError("PP value should be below **{:.02f}pp** for this map.".format(previous_pp))
+    if args.pp >= max_pp:
+        raise ValueError("PP value should be below **{:.02f}pp** for this map.".format(max_pp))
 
-    dec = .05
-    acc = 100.0 - dec
-    while True:
+    # pp grows with accuracy, so bisect the accuracy range until the bracket is within the precision
+    low_acc, low_pp = 0.0, min_pp
+    high_acc, high_pp = 100.0, max_pp
+    while high_acc - low_acc > closest_pp_precision:
+        acc = (low_acc + high_acc) / 2
         current_pp = calc(accuracy=acc)
 
-        # Stop when we find a pp value between the current 100 count and the previous one
-        if current_pp <= args.pp <= previous_pp:
-            break
+        if current_pp < args.pp:
+            low_acc, low_pp = acc, current_pp
         else:
-            previous_pp = current_pp
-            acc -= dec
+            high_acc, high_pp = acc, current_pp
 
     # Calculate the star difficulty
     totalstars = ezpp_stars(ez)
@@ -244,8 +380,10 @@ async def find_closest_pp(beatmap, args):
     # Parse difficulty name
     version = ezpp_version(ez)
 
-    # Find the closest pp of our two values, and return the amount of 100s
-    closest_pp = min([previous_pp, current_pp], key=lambda v: abs(args.pp - v))
-    acc = acc if closest_pp == current_pp else acc + dec
+    # Find the closest pp of our two bracketing values, and return the accuracy
+    if abs(args.pp - low_pp) < abs(args.pp - high_pp):
+        acc, closest_pp = low_acc, low_pp
+    else:
+        acc, closest_pp = high_acc, high_pp
     return ClosestPPStats(round(acc, 2), closest_pp, totalstars, artist, title,
                           version)
@@ -1,9 +1,13 @@
 """ Plugin for generating markov text, or a summary if you will. """
 
+import heapq
+import json
 import logging
+import os
 import random
 import re
-from collections import defaultdict, deque
+from collections import defaultdict, deque, Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 import asyncio
@@ -26,8 +30,23 @@ stored_messages = defaultdict(partial(deque, maxlen=10000))
 logs_from_limit = 5000
 max_summaries = 15
 max_admin_summaries = 15
-update_task = asyncio.Event()
-update_task.set()
+update_tasks = {}  # Messages being downloaded, where every key is a channel id
+
+# Markov chains of every channel's messages, where every key is (channel id, bots)
+markov_chains = {}
+
+# Word and author indexes of every channel's messages, where every key is a channel id
+message_indexes = {}
+
+# Recently used summary models, where every key is (channel id, member ids, bots, phrase, regex, case, command prefix)
+summary_models = OrderedDict()
+max_summary_models = 32
+summary_model_generations = defaultdict(int)  # Increased whenever the models of a channel are invalidated
+
+summary_workers = 2  # The number of worker threads used for building markovify models and generating sentences
+summary_executor = None  # Created on first use by get_summary_executor()
+summary_time_budget = 30  # The number of seconds a summary request may spend generating summaries
+markovify_max_removed = 1000  # The number of messages removed from a model before its markovify model is rebuilt
 
 # Define some regexes for option checking in "summary" command
 valid_num = re.compile(r"\*(?P<num>\d+)")
@@ -41,26 +60,358 @@ on_no_messages = "**There were no messages to generate a summary from, {0.author
 on_fail = "**I was unable to construct a summary, {0.author.name}.**"
 
 summary_options = Config("summary_options", data=dict(no_bot=False, no_self=False, persistent_channels=[]), pretty=True)
-summary_data = Config("summary_data", data=dict(channels={}))
+summary_data = Config("summary_data", data=dict(backfill={}))
+
+# Persistent messages are appended to a JSON lines file per channel, and loaded when first used
+persistent_messages_path = os.path.join(Config.config_path, "summary_messages")
+persistent_messages = {}  # Loaded persistent messages, where every key is a channel id
+
+# Persistent messages are downloaded in chunks, and the backfill config stores the id of the last
+# downloaded message and the number of stored messages in every channel that is not yet fully downloaded
+backfill_limit = 1000000
+backfill_chunk_size = 5000
+backfill_pending = {}  # Messages sent while downloading, where every key is a channel id
 
 
 def to_persistent(message: discord.Message):
     return dict(content=message.clean_content, author=message.author.id, bot=message.author.bot)
 
 
-async def update_messages(channel: discord.Channel):
-    """ Download messages. """
-    messages = stored_messages[channel.id]  # type: deque
+def get_persistent_messages_file(channel_id: str):
+    return os.path.join(persistent_messages_path, "{}.jsonl".format(channel_id))
 
-    # We only want to log messages when there are none
-    # Any messages after this logging will be logged in the on_message event
-    if messages:
-        return
 
-    # Make sure not to download messages twice by setting this handy task
-    update_task.clear()
+def write_persistent_messages(channel_id: str, messages: list, mode: str="a"):
+    """ Append the messages to the persistent messages file of the channel, or replace the file with mode "w". """
+    if not os.path.exists(persistent_messages_path):
+        os.mkdir(persistent_messages_path)
+
+    with open(get_persistent_messages_file(channel_id), mode) as f:
+        f.writelines(json.dumps(m) + "\n" for m in messages)
+
+
+def get_persistent_messages(channel_id: str):
+    """ Return the persistent messages of the channel, loading them from file when first used.
+    Messages stored after the backfill checkpoint of an interrupted download are removed. """
+    if channel_id in persistent_messages:
+        return persistent_messages[channel_id]
+
+    messages = []
+    changed = False
+    filename = get_persistent_messages_file(channel_id)
+    if os.path.exists(filename):
+        with open(filename) as f:
+            for line in f:
+                try:
+                    messages.append(json.loads(line))
+                except ValueError:  # The last message was only partially written
+                    changed = True
+                    break
+
+    checkpoint = summary_data.data["backfill"].get(channel_id)
+    if checkpoint is not None and len(messages) > checkpoint["count"]:
+        del messages[checkpoint["count"]:]
+        changed = True
+
+    if changed:
+        write_persistent_messages(channel_id, messages, mode="w")
+
+    persistent_messages[channel_id] = messages
+    return messages
+
+
+def store_persistent_messages(channel: discord.Channel, messages: list):
+    """ Append the messages to the persistent messages of the channel. """
+    write_persistent_messages(channel.id, messages)
+
+    stored = get_persistent_messages(channel.id)
+    for message in messages:
+        stored.append(message)
+        update_summary_indexes(channel, message)
+
+
+# Persistent messages used to be stored in the summary_data config
+if "channels" in summary_data.data:
+    for _channel_id, _messages in summary_data.data.pop("channels").items():
+        write_persistent_messages(_channel_id, _messages, mode="w")
+    summary_data.save()
+
+
+class MarkovChain:
+    """ Word transitions of a set of messages, used for generating summaries
+    with markov_messages(). Messages can be added and removed as they come and go. """
+    def __init__(self, messages=(), command_prefix: str=None):
+        self.command_prefix = command_prefix
+        self.messages = deque()
+        self.successors = defaultdict(Counter)  # Every following word (in any case) of a lowercase word
+        self.endings = Counter()  # Number of messages ending with a lowercase word
+        self.containing = Counter()  # Number of messages containing a lowercase word
+        self.single = Counter()  # Number of messages only containing a lowercase word
+
+        for content in messages:
+            self.add(content)
+
+    def _update(self, content: str, n: int):
+        """ Add n to every count of the given message. """
+        words = content.split()
+        lower_words = [word.lower() for word in words]
+
+        for word in set(lower_words):
+            self._count(self.containing, word, n)
+        if len(words) == 1:
+            self._count(self.single, lower_words[0], n)
+        self._count(self.endings, lower_words[-1], n)
+
+        for word, next_word in zip(lower_words, words[1:]):
+            self._count(self.successors[word], next_word, n)
+            if not self.successors[word]:
+                del self.successors[word]
+
+    @staticmethod
+    def _count(counter: Counter, key: str, n: int):
+        """ Add n to the count of key, and remove the key when there are none left. """
+        counter[key] += n
+        if counter[key] <= 0:
+            del counter[key]
+
+    def add(self, content: str):
+        """ Add a message to the chain. """
+        if not content.split():
+            return
+
+        self.messages.append(content)
+        self._update(content, 1)
+
+    def remove(self, content: str):
+        """ Remove a message from the chain. Messages are usually removed in the order they were added. """
+        if not content.split():
+            return
+
+        if self.messages and self.messages[0] == content:
+            self.messages.popleft()
+        else:
+            self.messages.remove(content)
+        self._update(content, -1)
+
+    def random_successor(self, word: str):
+        """ Return a random word following the given lowercase word, weighted by occurrences. """
+        successors = self.successors[word]
+        n = random.randint(1, sum(successors.values()))
+        for successor, count in successors.items():
+            n -= count
+            if n <= 0:
+                return successor
+
+    def ends_with_bias(self, word: str):
+        """ Decide whether to pick a message where the given word is the last word, rather
+        than one where it's followed by another word. The latter is preferred. """
+        ending = self.endings[word]
+        following = self.containing[word] - ending
+
+        if not ending:
+            return False
+        elif following <= 0:
+            return True
+        else:
+            return random.randint(0, 5) == 0
+
+
+class MessageIndex:
+    """ Inverted index of the lowercase words and authors in a sequence of messages, used for
+    finding the messages containing a phrase or sent by some members without searching through
+    all of them. Messages are added to the end and removed from the start, and are referred to
+    by offsets. """
+    def __init__(self, messages=()):
+        self.offsets = defaultdict(deque)  # Offsets of every message containing a lowercase word
+        self.author_offsets = defaultdict(deque)  # Offsets of every message sent by an author id
+        self.start = 0  # Offset of the first message
+        self.end = 0  # Offset following the last message
+
+        for message in messages:
+            self.add(message)
+
+    @staticmethod
+    def words(message: dict):
+        return set(to_summary_content(message).lower().split())
+
+    def add(self, message: dict):
+        """ Add a message to the end. """
+        for word in self.words(message):
+            self.offsets[word].append(self.end)
+        self.author_offsets[message["author"]].append(self.end)
+        self.end += 1
+
+    def remove(self, message: dict):
+        """ Remove the first message. """
+        for word in self.words(message):
+            offsets = self.offsets[word]
+            offsets.popleft()
+            if not offsets:
+                del self.offsets[word]
+
+        author_offsets = self.author_offsets[message["author"]]
+        author_offsets.popleft()
+        if not author_offsets:
+            del self.author_offsets[message["author"]]
+        self.start += 1
+
+    def _find_word(self, word: str, whole_start: bool, whole_end: bool):
+        """ Return the offsets of every message with a word matching the given part of a phrase.
+        whole_start and whole_end tell if the part is preceded or followed by whitespace. """
+        if whole_start and whole_end:
+            return set(self.offsets.get(word, ()))
+
+        offsets = set()
+        for indexed_word, word_offsets in self.offsets.items():
+            if (indexed_word.startswith(word) if whole_start else
+                    indexed_word.endswith(word) if whole_end else word in indexed_word):
+                offsets.update(word_offsets)
+        return offsets
+
+    def find(self, phrase: str):
+        """ Return the sorted offsets of the messages which may contain the phrase, ignoring case.
+        Returns None when the phrase has no words to look for. """
+        words = phrase.lower().split()
+        if not words:
+            return None
+
+        # Words surrounded by whitespace must be whole words in the message, so we only need to
+        # look for the others when there are no such words
+        parts = [(word, i > 0 or phrase[:1].isspace(), i < len(words) - 1 or phrase[-1:].isspace())
+                 for i, word in enumerate(words)]
+        whole_parts = [part for part in parts if part[1] and part[2]]
+
+        candidates = None
+        for part in whole_parts or parts:
+            offsets = self._find_word(*part)
+            candidates = offsets if candidates is None else candidates & offsets
+            if not candidates:
+                break
+
+        return sorted(candidates)
+
+    def find_authors(self, author_ids: frozenset):
+        """ Return the sorted offsets of the messages sent by any of the given author ids. """
+        return list(heapq.merge(*(self.author_offsets.get(author_id, ()) for author_id in author_ids)))
+
+    def search(self, messages, phrase: str=None, author_ids: frozenset=None):
+        """ Yield the messages which may contain the phrase and are sent by any of the given
+        author ids. messages must be the indexed messages. """
+        offsets = self.find(phrase) if phrase else None
+        if author_ids:
+            author_offsets = self.find_authors(author_ids)
+            offsets = author_offsets if offsets is None else sorted(set(offsets).intersection(author_offsets))
+
+        if offsets is None:
+            yield from messages
+            return
+
+        for offset in offsets:
+            yield messages[offset - self.start]
+
+
+def get_summary_executor():
+    """ Return the thread pool used for generating summaries outside of the event loop. """
+    global summary_executor
+    if summary_executor is None:
+        summary_executor = ThreadPoolExecutor(max_workers=summary_workers)
+
+    return summary_executor
+
+
+def make_markovify_model(message_content: list):
+    """ Build a markovify model of the messages, or return None when it can't be built.
+    This function is meant to be run in the summary executor. """
+    try:
+        return markovify.Text(message_content)
+    except KeyError:
+        return None
+
+
+def update_markovify_model(markovify_model, new_content: list, message_content: list):
+    """ Combine the markovify model with a model of the new messages, or build a model of every
+    message when there is none. This function is meant to be run in the summary executor. """
+    if markovify_model is None:
+        return make_markovify_model(message_content)
+
+    new_model = make_markovify_model(new_content)
+    if new_model is None:
+        return markovify_model
+
+    return markovify.combine([markovify_model, new_model])
+
+
+def make_markovify_sentence(markovify_model, phrase: str=None):
+    """ Generate a sentence, starting with the phrase when it ends with "...".
+    This function is meant to be run in the summary executor. """
+    if phrase and is_endswith(phrase):
+        try:
+            return markovify_model.make_sentence_with_start(phrase[:-3])
+        except KeyError:
+            pass
+
+    return markovify_model.make_sentence(tries=1000)
+
+
+class SummaryModel:
+    """ The messages and models used for generating summaries with one set of arguments. When a chain
+    is given, it's the shared chain of the channel and its messages are used as the model's messages. """
+    def __init__(self, message_content: list=None, chain: MarkovChain=None):
+        self.shared_chain = chain is not None
+        self.message_content = chain.messages if self.shared_chain else message_content
+        self.chain = chain or MarkovChain(message_content)
+        self._markovify_model = None
+        self._new_content = []  # Messages added since the markovify model was built
+        self._removed = 0  # Number of messages removed since the markovify model was built
+
+    def add(self, content: str):
+        """ Add a message to the model. The message is added to the markovify model when next used. """
+        if not self.shared_chain:
+            self.message_content.append(content)
+            self.chain.add(content)
+        if self._markovify_model is not None:
+            self._new_content.append(content)
+
+    def remove(self, content: str):
+        """ Remove a message from the model, usually the oldest one. Markovify models can't remove
+        messages, so the markovify model is rebuilt after markovify_max_removed messages. """
+        if not self.shared_chain:
+            if self.message_content and self.message_content[0] == content:
+                del self.message_content[0]
+            else:
+                self.message_content.remove(content)
+            self.chain.remove(content)
+        if self._markovify_model is not None:
+            self._removed += 1
+
+    @staticmethod
+    async def _update_markovify_model(markovify_model: asyncio.Future, new_content: list, message_content: list):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(get_summary_executor(), update_markovify_model, await markovify_model,
+                                          new_content, message_content)
+
+    def markovify_model(self):
+        """ Return a future of the markovify model of the messages, which is built in the summary
+        executor when first used and updated with the messages added since. The result is None when
+        the model can't be built, and the future raises NameError when markovify is not imported. """
+        loop = asyncio.get_event_loop()
+        if self._markovify_model is None or self._removed > markovify_max_removed:
+            self._markovify_model = loop.run_in_executor(get_summary_executor(), make_markovify_model,
+                                                         list(self.message_content))
+            self._new_content = []
+            self._removed = 0
+        elif self._new_content:
+            self._markovify_model = asyncio.ensure_future(
+                self._update_markovify_model(self._markovify_model, self._new_content, list(self.message_content)))
+            self._new_content = []
+
+        return self._markovify_model
+
+
+async def download_messages(channel: discord.Channel):
+    """ Download the past messages of the channel. """
+    messages = stored_messages[channel.id]  # type: deque
 
-    # Download logged messages
     try:
         async for m in client.logs_from(channel, limit=logs_from_limit):
             if not m.content:
@@ -70,48 +421,47 @@ async def update_messages(channel: discord.Channel):
             messages.appendleft(to_persistent(m))
     except:  # When something goes wrong, clear the messages
         messages.clear()
-    finally:  # Really have to make sure we clear this task in all cases
-        update_task.set()
+    finally:
+        reset_summary_models(channel)
+
+
+async def update_messages(channel: discord.Channel):
+    """ Download messages, or wait for the messages of the channel to be downloaded. """
+    # Make sure not to download messages twice by waiting for the same download
+    if channel.id not in update_tasks:
+        # We only want to log messages when there are none
+        # Any messages after this logging will be logged in the on_message event
+        if stored_messages[channel.id]:
+            return
+
+        update_tasks[channel.id] = asyncio.ensure_future(download_messages(channel))
+        update_tasks[channel.id].add_done_callback(lambda _: update_tasks.pop(channel.id, None))
+
+    await asyncio.shield(update_tasks[channel.id])
 
 
 async def on_reload(name: str):
     """ Preserve the summary message cache when reloading. """
-    global stored_messages
+    global stored_messages, persistent_messages, markov_chains, message_indexes, summary_models
     local_messages = stored_messages
+    local_persistent_messages = persistent_messages
+    local_chains = markov_chains
+    local_indexes = message_indexes
+    local_models = summary_models
 
     await plugins.reload(name)
 
     stored_messages = local_messages
+    persistent_messages = local_persistent_messages
+    markov_chains = local_chains
+    message_indexes = local_indexes
+    summary_models = local_models
 
 
-def indexes_of_word(words: list, word: str):
-    """ Return a list of indexes with the given word. """
-    return [i for i, s in enumerate(words) if s.lower() == word]
-
-
-def random_with_bias(messages: list, word: str):
-    """ Go through all the messages and try to choose the ones where the given word is
-    not at the end of the string. """
-    last_word_messages = []
-    non_last_word_messages = []
-    for m in messages:
-        words = m.split()
-        if words[-1].lower() == word:
-            last_word_messages.append(m)
-        else:
-            non_last_word_messages.append(m)
-
-    if not last_word_messages:
-        return random.choice(non_last_word_messages)
-    elif not non_last_word_messages:
-        return random.choice(last_word_messages)
-    else:
-        return random.choice(last_word_messages if random.randint(0, 5) == 0 else non_last_word_messages)
-
-
-def markov_messages(messages, coherent=False):
+def markov_messages(chain: MarkovChain, coherent=False):
     """ Generate some kind of markov chain that somehow works with discord.
     I found this makes better results than markovify would. """
+    messages = chain.messages
     imitated = []
     word = ""
 
@@ -132,27 +482,18 @@ def markov_messages(messages, coherent=False):
 
     # Add the first word
     imitated.append(word)
-    valid = []
-    im = ""
 
     # Next words
     while True:
-        # Set the last word and find all messages with the last word in it
-        if not im == imitated[-1].lower():
-            im = imitated[-1].lower()
-            valid = [m for m in messages if im in m.lower().split()]
+        # Find the number of messages with the last word in it
+        im = imitated[-1].lower()
+        valid = chain.containing[im]
 
-        # Add a word from the message found
+        # Add a word following the last word
         if valid:
-            # # Choose one of the matched messages and split it into a list or words
-            m = random_with_bias(valid, im).split()
-            m_indexes = indexes_of_word(m, im)
-            m_index = random.choice(m_indexes)  # Choose a random index
-            m_from = m[m_index:]
-
-            # Are there more than the matched word in the message (is it not the last word?)
-            if len(m_from) > 1:
-                imitated.append(m_from[1])  # Then we'll add the next word
+            # Is the word not the last word in the chosen message?
+            if not chain.ends_with_bias(im):
+                imitated.append(chain.random_successor(im))  # Then we'll add the next word
                 continue
             else:
                 # Have the chance of breaking be 1/4 at start and 1/1 when imitated approaches 150 words
@@ -164,7 +505,7 @@ def markov_messages(messages, coherent=False):
                     break
 
         # Add a random word if all valid messages are one word or there are less than 2 messages
-        if len(valid) <= 1 or all(len(m.split()) <= 1 for m in valid):
+        if valid <= 1 or valid == chain.single[im]:
             seq = random.choice(messages).split()
             word = random.choice(seq)
             imitated.append(word)
@@ -199,20 +540,185 @@ def is_valid_option(arg: str):
     return False
 
 
+def is_included(message: dict, bots: bool):
+    """ Return False when the message is a bot message and bots are excluded, or when
+    it's our own message and the no_self option is enabled in the config. """
+    if not bots:
+        return not message["bot"]
+    elif summary_options.data["no_self"]:
+        return not message["author"] == client.user.id
+
+    return True
+
+
+def to_summary_content(message: dict):
+    """ Return the content of the message, with new lines replaced to make them persist through splitting. """
+    return message["content"].replace("\n", NEW_LINE_IDENTIFIER)
+
+
 def filter_messages_by_arguments(messages, channel, member, bots):
     # Split the messages into content and filter member and phrase
-    messages = (m for m in messages if not member or m["author"] in [mm.id for mm in member])
+    if member:
+        member_ids = frozenset(m.id for m in member)
+        messages = (m for m in messages if m["author"] in member_ids)
 
     # Filter bot messages or own messages if the option is enabled in the config
-    if not bots:
-        messages = (m for m in messages if not m["bot"])
-    elif summary_options.data["no_self"]:
-        messages = (m for m in messages if not m["author"] == client.user.id)
+    messages = (m for m in messages if is_included(m, bots))
 
     # Convert all messages to content
     return (m["content"] for m in messages)
 
 
+def get_markov_chain(channel: discord.Channel, messages, bots: bool, command_prefix: str):
+    """ Return the markov chain of every message in the channel without commands. The chain
+    is kept up to date as messages are sent, see update_markov_chains(). """
+    key = (channel.id, bots)
+    if key not in markov_chains or markov_chains[key].command_prefix != command_prefix:
+        markov_chains[key] = MarkovChain((to_summary_content(m) for m in messages if is_included(m, bots)
+                                          and not m["content"].startswith(command_prefix)), command_prefix)
+
+    return markov_chains[key]
+
+
+def update_markov_chains(channel: discord.Channel, message: dict, add: bool=True):
+    """ Add or remove the message from every markov chain of the channel. """
+    for bots in (True, False):
+        chain = markov_chains.get((channel.id, bots))
+        if chain is None or not is_included(message, bots) or message["content"].startswith(chain.command_prefix):
+            continue
+
+        if add:
+            chain.add(to_summary_content(message))
+        else:
+            chain.remove(to_summary_content(message))
+
+
+def get_message_index(channel: discord.Channel, messages):
+    """ Return the message index of every message in the channel. The index is kept up
+    to date as messages are sent, see update_summary_indexes(). """
+    if channel.id not in message_indexes:
+        message_indexes[channel.id] = MessageIndex(messages)
+
+    return message_indexes[channel.id]
+
+
+def update_summary_indexes(channel: discord.Channel, message: dict, add: bool=True):
+    """ Add the message to, or remove the oldest message from, the markov chains, message
+    index and summary models of the channel. """
+    update_markov_chains(channel, message, add)
+    update_summary_models(channel, message, add)
+
+    index = message_indexes.get(channel.id)
+    if index is not None:
+        if add:
+            index.add(message)
+        else:
+            index.remove(message)
+
+
+async def get_summary_model(channel: discord.Channel, messages, member: list, bots: bool, phrase: str, regex: bool,
+                            case: bool, command_prefix: str):
+    """ Return the summary model of the messages filtered by the given arguments. Models are
+    kept up to date as messages are sent, see update_summary_models(). """
+    member_ids = frozenset(m.id for m in member)
+    key = (channel.id, member_ids, bots, phrase, regex, case, command_prefix)
+    if key in summary_models:
+        summary_models.move_to_end(key)
+        return summary_models[key]
+    generation = summary_model_generations[channel.id]
+
+    # Use the channel's markov chain when no messages are filtered by member or phrase
+    if not member and (phrase is None or (is_endswith(phrase) and not phrase.startswith(command_prefix))):
+        chain = get_markov_chain(channel, messages, bots, command_prefix)
+        model = SummaryModel(chain=chain)
+    else:
+        # Only go through the messages which may contain the phrase and are sent by the members
+        search_phrase = phrase if phrase and not is_endswith(phrase) and not regex else None
+        if search_phrase or member_ids:
+            messages = get_message_index(channel, messages).search(messages, search_phrase, member_ids)
+
+        message_content = filter_messages_by_arguments(messages, channel, member, bots)
+
+        # Replace new lines with text to make them persist through splitting
+        message_content = [s.replace("\n", NEW_LINE_IDENTIFIER) for s in message_content]
+
+        # Filter looking for phrases if specified
+        if phrase and not is_endswith(phrase):
+            if regex:
+                # Regex can't use the message index, so search every message without blocking the event loop
+                loop = asyncio.get_event_loop()
+                message_content = await loop.run_in_executor(
+                    get_summary_executor(), lambda: list(filter_messages(message_content, phrase, regex, case)))
+            else:
+                message_content = list(filter_messages(message_content, phrase, regex, case))
+
+        # Clean up by removing all commands from the summaries
+        if phrase is None or not phrase.startswith(command_prefix):
+            message_content = [s for s in message_content if not s.startswith(command_prefix)]
+
+        model = SummaryModel(list(message_content))
+
+    # Messages may have been sent while filtering, in which case the model is missing them
+    if generation != summary_model_generations[channel.id]:
+        return model
+
+    # Remove the least recently used model when there are too many
+    summary_models[key] = model
+    if len(summary_models) > max_summary_models:
+        summary_models.popitem(last=False)
+
+    return model
+
+
+def is_summarized(key: tuple, message: dict):
+    """ Return True when the message is included in the summary model of the given key. """
+    channel_id, member_ids, bots, phrase, regex, case, command_prefix = key
+    if member_ids and message["author"] not in member_ids or not is_included(message, bots):
+        return False
+
+    content = to_summary_content(message)
+    if phrase is None or not phrase.startswith(command_prefix):
+        if content.startswith(command_prefix):
+            return False
+    if phrase and not is_endswith(phrase):
+        return bool(list(filter_messages([content], phrase, regex, case)))
+
+    return True
+
+
+def update_summary_models(channel: discord.Channel, message: dict, add: bool=True):
+    """ Add or remove the message from every summary model of the channel which includes it.
+    Models of the shared markov chains are updated by update_markov_chains(). """
+    summary_model_generations[channel.id] += 1
+    for key, model in list(summary_models.items()):
+        if key[0] != channel.id or not is_summarized(key, message):
+            continue
+
+        # The model is outdated when its shared chain has been replaced
+        if model.shared_chain and markov_chains.get((channel.id, key[2])) is not model.chain:
+            del summary_models[key]
+        elif add:
+            model.add(to_summary_content(message))
+        else:
+            model.remove(to_summary_content(message))
+
+
+def invalidate_summary_models(channel: discord.Channel):
+    """ Remove every summary model of the channel, as they no longer include all messages. """
+    summary_model_generations[channel.id] += 1
+    for key in [key for key in summary_models if key[0] == channel.id]:
+        del summary_models[key]
+
+
+def reset_summary_models(channel: discord.Channel):
+    """ Remove the markov chains, message index and summary models of the channel, so that
+    they are built from scratch when the messages have been replaced. """
+    for bots in (True, False):
+        markov_chains.pop((channel.id, bots), None)
+    message_indexes.pop(channel.id, None)
+    invalidate_summary_models(channel)
+
+
 def is_endswith(phrase):
     return phrase.endswith("...") and len(phrase.split()) in (1, 2)
 
@@ -293,55 +799,52 @@ async def summary(message: discord.Message, *options, phrase: Annotate.Content=N
     await client.send_typing(message.channel)
     
     if channel.id in summary_options.data["persistent_channels"]:
-        messages = summary_data.data["channels"][channel.id]
+        messages = get_persistent_messages(channel.id)
     else:
-        await update_task.wait()
         await update_messages(channel)
         messages = stored_messages[channel.id]
     
-    message_content = filter_messages_by_arguments(messages, channel, member, bots)
-
-    # Replace new lines with text to make them persist through splitting
-    message_content = (s.replace("\n", NEW_LINE_IDENTIFIER) for s in message_content)
-
-    # Filter looking for phrases if specified
-    if phrase and not is_endswith(phrase):
-        message_content = list(filter_messages(message_content, phrase, regex, case))
-
     command_prefix = config.server_command_prefix(message.server)
-    # Clean up by removing all commands from the summaries
-    if phrase is None or not phrase.startswith(command_prefix):
-        message_content = [s for s in message_content if not s.startswith(command_prefix)]
+    model = await get_summary_model(channel, messages, member, bots, phrase, regex, case, command_prefix)
+    chain = model.chain
 
     # Check if we even have any messages
-    assert message_content, on_no_messages.format(message)
+    assert model.message_content, on_no_messages.format(message)
+
+    # Markovify runs in the summary executor, and falls back to our own markov chain when
+    # it's out of time, so that long summaries don't block the bot
+    loop = asyncio.get_event_loop()
+    time_left = summary_time_budget
 
     markovify_model = None
     if strict:
+        started = loop.time()
         try:
-            markovify_model = markovify.Text(message_content)
+            markovify_model = await asyncio.wait_for(asyncio.shield(model.markovify_model()), time_left)
         except NameError:
             logging.warning("+strict was used but markovify is not imported")
             strict = False
-        except KeyError:
+        except asyncio.TimeoutError:
             markovify_model = None
+        time_left -= loop.time() - started
 
     # Generate the summary, or num summaries
     for i in range(num):
-        if strict and markovify_model:
-            if phrase and is_endswith(phrase):
-                try:
-                    sentence = markovify_model.make_sentence_with_start(phrase[:-3])
-                except KeyError:
-                    sentence = markovify_model.make_sentence(tries=1000)
-
-            else:
-                sentence = markovify_model.make_sentence(tries=1000)
+        sentence = None
+        if strict and markovify_model and time_left > 0:
+            started = loop.time()
+            try:
+                sentence = await asyncio.wait_for(
+                    loop.run_in_executor(get_summary_executor(), make_markovify_sentence, markovify_model, phrase),
+                    time_left)
+            except asyncio.TimeoutError:
+                pass
+            time_left -= loop.time() - started
         else:
-            sentence = markov_messages(message_content, coherent)
+            sentence = markov_messages(chain, coherent)
 
         if not sentence:
-            sentence = markov_messages(message_content, coherent)
+            sentence = markov_messages(chain, coherent)
 
         assert sentence, on_fail.format(message)
 
@@ -354,13 +857,25 @@ async def summary(message: discord.Message, *options, phrase: Annotate.Content=N
 @plugins.event(bot=True, self=True)
 async def on_message(message: discord.Message):
     """ Whenever a message is sent, see if we can update in one of the channels. """
+    persistent = message.channel.id in summary_options.data["persistent_channels"]
+
     if message.channel.id in stored_messages and message.content:
-        stored_messages[message.channel.id].append(to_persistent(message))
+        messages = stored_messages[message.channel.id]
+
+        # The oldest message is removed when the cache is full
+        if not persistent and len(messages) == messages.maxlen:
+            update_summary_indexes(message.channel, messages[0], add=False)
+
+        messages.append(to_persistent(message))
+        if not persistent:
+            update_summary_indexes(message.channel, messages[-1])
     
-    # Store to persistent if enabled for this channel
-    if message.channel.id in summary_options.data["persistent_channels"]:
-        summary_data.data["channels"][message.channel.id].append(to_persistent(message))
-        summary_data.save()
+    # Store to persistent if enabled for this channel. Messages sent while downloading the
+    # channel's messages are added after the download
+    if persistent and message.channel.id in summary_data.data["backfill"]:
+        backfill_pending.setdefault(message.channel.id, []).append((message.id, to_persistent(message)))
+    elif persistent:
+        store_persistent_messages(message.channel, [to_persistent(message)])
 
 
 @summary.command(owner=True)
@@ -373,18 +888,77 @@ async def enable_persistent_messages(message: discord.Message):
     summary_options.data["persistent_channels"].append(message.channel.id)
     summary_options.save()
 
-    await client.say(message, "Downloading messages. This may take a while.")
-    
     # Create the persistent storage
-    summary_data.data["channels"][message.channel.id] = []
+    persistent_messages[message.channel.id] = []
+    write_persistent_messages(message.channel.id, [], mode="w")
+    summary_data.data["backfill"][message.channel.id] = dict(last_id=None, count=0)
+    summary_data.save()
 
-    # Download EVERY message in the channel
-    async for m in client.logs_from(message.channel, limit=1000000):
-        if not m.content:
-            continue
+    # The models of this channel are now built from the persistent messages
+    reset_summary_models(message.channel)
+
+    progress_message = await client.say(message, "Downloading messages. This may take a while.")
+    count = await backfill_persistent_messages(message.channel, progress_message)
+    await client.say(message, "Downloaded {} messages!".format(count))
 
-        # We have no messages, so insert each from the left, leaving us with the oldest at index -1
-        summary_data.data["channels"][message.channel.id].insert(0, to_persistent(m))
 
+async def backfill_persistent_messages(channel: discord.Channel, progress_message: discord.Message=None):
+    """ Download every message in the channel to persistent storage, oldest first. The messages
+    are appended in chunks, and the id of the last message is saved after every chunk so that
+    the download resumes from there when interrupted.
+
+    :param progress_message: A message to edit with the progress of the download.
+    :return: The number of messages in persistent storage.
+    """
+    messages = get_persistent_messages(channel.id)
+    last_id = summary_data.data["backfill"][channel.id]["last_id"] or channel.id  # No message is older than the channel
+    chunk = []
+    downloaded = 0
+
+    def store_chunk():
+        """ Store the downloaded chunk, and then the id of its last message and the number of stored
+        messages. Messages stored after this checkpoint are removed when loading, so that the stored
+        messages always end with the last message. """
+        store_persistent_messages(channel, chunk)
+        chunk.clear()
+
+        summary_data.data["backfill"][channel.id] = dict(last_id=last_id, count=len(messages))
+        summary_data.save()
+
+    async for m in client.logs_from(channel, limit=backfill_limit, after=discord.Object(id=last_id), reverse=True):
+        last_id = m.id
+        downloaded += 1
+
+        if m.content:
+            chunk.append(to_persistent(m))
+
+        # Save every chunk, so that we can continue from here
+        if downloaded % backfill_chunk_size == 0:
+            store_chunk()
+
+            logging.info("Downloaded {} messages in #{} ({} stored)".format(downloaded, channel, len(messages)))
+            if progress_message:
+                progress_message = await client.edit_message(
+                    progress_message, "Downloading messages. {} stored so far.".format(len(messages)))
+
+    store_chunk()
+
+    # Add any messages sent during the download which were not downloaded
+    store_persistent_messages(channel, [message for message_id, message in backfill_pending.pop(channel.id, [])
+                                        if int(message_id) > int(last_id)])
+
+    del summary_data.data["backfill"][channel.id]
     summary_data.save()
-    await client.say(message, "Downloaded {} messages!".format(len(summary_data.data["channels"][message.channel.id])))
+
+    return len(messages)
+
+
+async def on_ready():
+    """ Continue downloading persistent messages that were interrupted. """
+    for channel_id in list(summary_data.data["backfill"]):
+        channel = client.get_channel(channel_id)
+        if channel is None:
+            continue
+
+        logging.info("Continuing the download of persistent messages in #{}".format(channel))
+        client.loop.create_task(backfill_persistent_messages(channel))